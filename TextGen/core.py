@@ -1,11 +1,20 @@
 import os
 import random
 import movis as mv
-from utils import ScreenGenerator, Intro_Image
+from utils import ScreenGenerator, Intro_Image, MessageStrip, metrics_cache, prefetch_emojis, \
+    background_standard_options
 from .helpers import *
+import bisect
 import requests
-import time
+import shutil
 import uuid
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Callable, Hashable, Iterator
+import cv2
+from PIL import Image
 
 
 class TextGenerationOllama:
@@ -22,10 +31,47 @@ class TextGenerationOllama:
             "model": "conv1",
             "prompt": self.prompt
         }
-        self.result = send_request_stream("http://localhost:11434/api/generate", body)
+        self.result = send_request_stream(ollama_settings['url'], body)
         self.result_formatted = format_text(self.result)
         return self.result_formatted
 
+    def iter_replicas(
+            self,
+            max_replicas: Optional[Union[None, int]] = None,
+            stop_on_error: Optional[bool] = False
+    ) -> Iterator[Tuple[bool, str]]:
+        """
+        Generates the conversation and yields each replica as soon as its line is complete. The first line of the
+        answer is skipped, like in `format_text`. Stopping the iteration closes the request, so the model stops
+        generating.
+        :param max_replicas: the generation is stopped after this number of replicas. Optional
+        :param stop_on_error: if true, the generation is stopped at the first line that is not a replica
+        :return: iterator of replicas
+        """
+
+        body = {
+            "model": "conv1",
+            "prompt": self.prompt
+        }
+        fragments = iter_request_stream(ollama_settings['url'], body)
+        self.result_formatted = []
+        try:
+            for i, line in enumerate(iter_text_lines(fragments)):
+                if i == 0 or not line.strip():
+                    continue
+                replica = parse_replica(line)
+                if replica is None:
+                    print('TextGenerationOllama ERROR: format text impossible:', line[:3])
+                    if stop_on_error:
+                        return
+                    continue
+                self.result_formatted.append(replica)
+                yield replica
+                if max_replicas is not None and len(self.result_formatted) >= max_replicas:
+                    return
+        finally:
+            fragments.close()
+
 
 class BatchTextGenerator:
     """
@@ -44,6 +90,65 @@ class BatchTextGenerator:
         if conversation_validation(conv):
             self.conversations.append(conv)
 
+    def prefetched_generation(self, themes: List[str], prefetch: Optional[int] = 2) -> None:
+        """
+        Generate a conversation for each theme, to be verified. The conversations are generated in the background while
+        the previous ones are being verified, so the verification does not wait on the model.
+        :param themes: themes that will be fed to the prompts
+        :param prefetch: number of conversations generated at the same time, at least 1
+        :return: None
+        """
+
+        for conv in self.iter_generated(themes, prefetch):
+            if conversation_validation(conv):
+                self.conversations.append(conv)
+
+    def iter_generated(self, themes: List[str], prefetch: Optional[int] = 2) -> Iterator[List[Tuple[bool, str]]]:
+        """
+        Generate a conversation for each theme in background threads, and yields them in the order they are ready.
+        At most `prefetch` conversations are generated at the same time and `prefetch` wait to be consumed.
+        :param themes: themes that will be fed to the prompts
+        :param prefetch: number of conversations generated at the same time, at least 1
+        :return: iterator of conversations
+        """
+
+        if prefetch < 1:  # no thread would generate the conversations
+            raise ValueError(f'prefetch must be at least 1, got {prefetch}')
+        theme_queue = queue.Queue()
+        for theme in themes:
+            theme_queue.put(theme)
+        ready_queue = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+
+        def work():
+            while not stop.is_set():
+                try:
+                    theme = theme_queue.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    conv = TextGenerationOllama(theme).generate_text()
+                except Exception as e:
+                    print('BatchTextGenerator ERROR: generation failed for theme', theme, repr(e))
+                    conv = None
+                while not stop.is_set():
+                    try:
+                        ready_queue.put(conv, timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+
+        threads = [threading.Thread(target=work, daemon=True) for _ in range(min(prefetch, len(themes)))]
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in range(len(themes)):
+                conv = ready_queue.get()
+                if conv:
+                    yield conv
+        finally:
+            stop.set()
+
 
 class TextToSpeechEleven:
     """
@@ -55,6 +160,7 @@ class TextToSpeechEleven:
             input_text: str
     ):
         self.input_text: str = input_text
+        self.from_cache: bool = False
         self._request_made: bool = False
         self._response: Union[requests.Response, None] = None
 
@@ -74,37 +180,223 @@ class TextToSpeechEleven:
             }
             data = {
                 "text": self.input_text,
-                "model_id": "eleven_multilingual_v2",
-                "voice_settings": {
-                    "stability": 0.5,
-                    "similarity_boost": 0.7,
-                    "style": 0.5
-                }
+                "model_id": tts_settings['model_id'],
+                "voice_settings": tts_settings['voice_settings']
             }
-            res = send_request(tts_settings['eleven_api_url'] + tts_settings['voice_id'], json_data=data,
-                               headers=headers)
+            with tts_request_slots:  # at most max_concurrent_requests in flight, for all the videos
+                tts_rate_limiter.acquire()
+                res = send_request(tts_settings['eleven_api_url'] + tts_settings['voice_id'], json_data=data,
+                                   headers=headers)
             if res.status_code != 200:
                 print('TTSEleven ERROR: request failed, error: ', res.status_code)
-                raise Exception()
-            time.sleep(1)
+                raise RequestError('TTS request failed', res.status_code)
             return res
 
     def generate_audio(self, path: str) -> None:
         """
-        Generates audio file
+        Generates audio file. If the same text has already been synthesized with the same settings, the file is copied
+        from `tts_audio_cache` and no request is sent.
         :param path: path to the audio file including the extension .mp3
         :return: None
         """
 
+        key = None
+        if tts_audio_cache is not None:
+            key = tts_audio_cache.make_key(self.input_text, tts_settings['voice_id'], tts_settings['model_id'],
+                                           tts_settings['voice_settings'])
+            cached_path = tts_audio_cache.get(key)
+            if cached_path is not None:
+                try:
+                    shutil.copyfile(cached_path, path)
+                    self.from_cache = True
+                    print('TTSEleven INFO: audio written from cache')
+                    return
+                except FileNotFoundError:  # evicted by another worker since
+                    print('TTSEleven INFO: cached audio evicted, sending the request')
+
         response = self.make_request()
         with open(path, 'wb') as f:
             for chunk in response.iter_content(chunk_size=1024):
                 if chunk:
                     f.write(chunk)
+        if key is not None:
+            tts_audio_cache.put(key, path)
 
         print('TTSEleven INFO: audio written')
 
 
+class ScrollLayer:
+    """
+    movis layer showing the messages of a conversation, scrolling smoothly to each new message. The frames are slices
+    of a `MessageStrip` pasted on the capture template. Once the scroll is over, the frame is the same as the capture.
+
+    :param start_times: time at which each message appears, relative to the layer
+    :param scroll_duration: duration of the scroll to a new message, in seconds
+    """
+
+    def __init__(
+            self,
+            strip: MessageStrip,
+            chrome: Image.Image,
+            start_times: List[float],
+            duration: float,
+            scroll_duration: Optional[float] = 0.3
+    ):
+        self.strip: MessageStrip = strip
+        self.chrome: Image.Image = chrome
+        self.start_times: List[float] = start_times
+        self.duration: float = duration
+        self.scroll_duration: float = scroll_duration
+
+        self._last_state: Optional[Tuple[int, int]] = None
+        self._last_frame: Optional[np.ndarray] = None
+
+    def get_state(self, time: float) -> Tuple[int, int]:
+        """
+        Calculate what is shown at a given time
+        :param time: time relative to the layer
+        :return: scroll offset and number of messages shown
+        """
+
+        count = max(1, bisect.bisect_right(self.start_times, time))
+        offset = self.strip.get_scroll_offset(count)
+        progress = (time - self.start_times[count - 1]) / self.scroll_duration if self.scroll_duration > 0 else 1
+        if count > 1 and progress < 1:
+            previous_offset = self.strip.get_scroll_offset(count - 1)
+            progress = max(0.0, progress)
+            eased = progress * progress * (3 - 2 * progress)
+            offset = int(round(previous_offset + (offset - previous_offset) * eased))
+        return offset, count
+
+    def get_key(self, time: float) -> Tuple[int, int]:
+        return self.get_state(time)
+
+    def __call__(self, time: float) -> np.ndarray:
+        state = self.get_state(time)
+        if state != self._last_state:
+            self._last_frame = np.asarray(self.strip.render_frame(self.chrome, *state))
+            self._last_state = state
+        return self._last_frame
+
+
+class TransformCache:
+    """
+    movis layer showing another layer rotated and scaled around the center, like the rotation and scale motions of
+    movis. The angle and the scale are rounded to a step, and the transformed frames are kept in a LRU cache keyed by
+    (frame of the layer, angle, scale), so a frame is transformed only once per rounded angle and scale while the layer
+    does not change. The same key is given to movis, so the parent composition also reuses its cached layer frames
+    instead of storing a new one at each video frame.
+
+    :param rotation: keyframes and values of the rotation in degrees, linearly interpolated
+    :param scale: keyframes and values of the scale, linearly interpolated
+    :param angle_step: the angle is rounded to a multiple of it. 0 to not round
+    :param scale_step: the scale is rounded to a multiple of it. 0 to not round
+    :param max_bytes: maximum size of the cached frames
+    """
+
+    def __init__(
+            self,
+            layer: Any,
+            rotation: Tuple[np.ndarray, np.ndarray],
+            scale: Tuple[np.ndarray, np.ndarray],
+            angle_step: Optional[float] = video_settings['transform_angle_step'],
+            scale_step: Optional[float] = video_settings['transform_scale_step'],
+            max_bytes: Optional[int] = video_settings['transform_cache_max_bytes']
+    ):
+        self.layer: Any = layer
+        self.rotation: Tuple[np.ndarray, np.ndarray] = rotation
+        self.scale: Tuple[np.ndarray, np.ndarray] = scale
+        self.angle_step: float = angle_step
+        self.scale_step: float = scale_step
+        self.max_bytes: int = max_bytes
+        self.duration: float = layer.duration
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self._frames: OrderedDict = OrderedDict()
+        self._bytes: int = 0
+
+    def get_transform(self, time: float) -> Tuple[float, float]:
+        """
+        Calculate the rounded angle and scale at a given time
+        :param time: time relative to the layer
+        :return: angle in degrees and scale
+        """
+
+        angle = float(np.interp(time, *self.rotation))
+        scale = float(np.interp(time, *self.scale))
+        if self.angle_step > 0:
+            angle = round(angle / self.angle_step) * self.angle_step
+        if self.scale_step > 0:
+            scale = round(scale / self.scale_step) * self.scale_step
+        return angle, scale
+
+    def get_key(self, time: float) -> Hashable:
+        layer_key = self.layer.get_key(time) if hasattr(self.layer, 'get_key') else time
+        return (layer_key,) + self.get_transform(time)
+
+    def __call__(self, time: float) -> Optional[np.ndarray]:
+        key = self.get_key(time)
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+
+        self.misses += 1
+        source = self.layer(time)
+        if source is None:
+            return None
+        frame = self._transform(source, *key[1:])
+        self._frames[key] = frame
+        self._bytes += frame.nbytes
+        while self._bytes > self.max_bytes and len(self._frames) > 1:
+            self._bytes -= self._frames.popitem(last=False)[1].nbytes
+        return frame
+
+    def get_audio(self, start_time: float, end_time: float) -> Optional[np.ndarray]:
+        # the audio of the layer is not transformed, movis ignores the layers without get_audio
+        if hasattr(self.layer, 'get_audio'):
+            return self.layer.get_audio(start_time, end_time)
+        return None
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def _transform(source: np.ndarray, angle: float, scale: float) -> np.ndarray:
+        """
+        Rotates and scales a frame around its center, with the same affine matrix, bounds and interpolation as movis
+        :param source: the RGBA frame
+        :param angle: angle in degrees
+        :param scale: scale
+        :return: the transformed frame, same size as the source
+        """
+
+        h, w = source.shape[:2]
+        cos_t = np.cos((2 * np.pi * angle) / 360)
+        sin_t = np.sin((2 * np.pi * angle) / 360)
+        matrix = np.array([[scale * cos_t, - scale * sin_t, 0], [scale * sin_t, scale * cos_t, 0], [0, 0, 1]])
+        matrix = np.array([[1, 0, w / 2], [0, 1, h / 2], [0, 0, 1]]) @ matrix @ \
+            np.array([[1, 0, - w / 2], [0, 1, - h / 2], [0, 0, 1]])
+
+        corners = np.array([[0, 0, 1], [0, h, 1], [w, 0, 1], [w, h, 1]], dtype=np.float64) @ matrix[:2].transpose()
+        x0, y0 = np.ceil(corners.min(axis=0)).astype(int)
+        x1, y1 = np.floor(corners.max(axis=0)).astype(int)
+        fixed = np.array([[1, 0, - x0], [0, 1, - y0], [0, 0, 1]]) @ matrix
+        transformed = cv2.warpAffine(source, fixed[:2], dsize=(int(x1 - x0), int(y1 - y0)), flags=cv2.INTER_LINEAR,
+                                     borderMode=cv2.BORDER_CONSTANT)
+
+        frame = np.zeros_like(source)
+        # part of the transformed frame inside the source bounds
+        fx0, fy0 = max(x0, 0), max(y0, 0)
+        fx1, fy1 = min(x1, w), min(y1, h)
+        if fx0 < fx1 and fy0 < fy1:
+            frame[fy0:fy1, fx0:fx1] = transformed[fy0 - y0:fy1 - y0, fx0 - x0:fx1 - x0]
+        return frame
+
+
 class VideoGenerator:
     """
     Main video rendering interface
@@ -124,63 +416,157 @@ class VideoGenerator:
         self.conversation_uuid: Optional[Union[uuid.UUID, int]] = conversation_uuid
 
         self._audio_files_generated: bool = False
-        self._audio_layers: List[mv.layer.media.Audio] = []  # each audio corresponds to a message of the conversation
+        # each audio corresponds to a message of the conversation, the durations are read from the headers
+        self._audio_files: List[str] = []
+        self._audio_durations: List[float] = []
 
         self._image_layers: List[mv.layer.media.Image] = []  # each image corresponds to a message of the conversation
+        self._screen_gen: Optional[ScreenGenerator] = None  # used for smooth scrolling, the captures are not rendered
 
     def generate_audio_files(self, path: str) -> None:
         """
-        Generate the audio files of each replica
+        Generate the audio files of each replica and of the intro. The requests are sent concurrently, at most
+        tts_settings['max_concurrent_requests'] at a time in the process (`tts_request_slots`), and rate limited by
+        `tts_rate_limiter`
         :return: None
         """
 
-        for i, replica in enumerate(self.conversation):
-            generator = TextToSpeechEleven(replica[1])
-            generator.generate_audio(path + f"{self.video_name}_aud_{'{:02d}'.format(i)}.mp3")
-            print('VideoGenerator INFO: generated audio file ' + str(i))
-
+        jobs = [(replica[1], path + f"{self.video_name}_aud_{'{:02d}'.format(i)}.mp3")
+                for i, replica in enumerate(self.conversation)]
         if self.intro_message:
-            generator = TextToSpeechEleven(self.intro_message)
-            generator.generate_audio(path + f"{self.video_name}_aud_intro.mp3")
-
-        save_characters("./data/stat.txt", self.conversation, self.conversation_uuid, self.intro_message)
+            jobs.append((self.intro_message, path + f"{self.video_name}_aud_intro.mp3"))
+
+        generators = [TextToSpeechEleven(text) for text, _ in jobs]
+        with ThreadPoolExecutor(max_workers=tts_settings['max_concurrent_requests']) as executor:
+            futures = [executor.submit(generator.generate_audio, file_path)
+                       for generator, (_, file_path) in zip(generators, jobs)]
+            for i, future in enumerate(futures):
+                future.result()
+                print('VideoGenerator INFO: generated audio file ' + str(i))
+
+        cached_characters = sum(character_counter_string(generator.input_text)
+                                for generator in generators if generator.from_cache)
+        if tts_audio_cache is not None:
+            print(f'VideoGenerator INFO: TTS cache hit rate: {tts_audio_cache.hit_rate():.1%}')
+        save_characters(None, self.conversation, self.conversation_uuid, self.intro_message,
+                        cached_characters=cached_characters)
         self._audio_files_generated = True
 
     def generate_audio_layers(self, path: str) -> None:
         """
-        Generate the audio layers of each file
+        Lists the audio file of each message with its duration, read from the headers (see `audio_metadata_cache`), so
+        the timeline is planned without decoding the files. They are decoded once by `generate_audio_track`
         :param path: the path to the audio file. Do not include the digits at the end nor the extension
         :return: None
         """
 
         if not self._audio_files_generated:
             self.generate_audio_files(path)
-        time.sleep(2)
 
-        if self.intro_message:
-            file_path = path + f"{self.video_name}_aud_intro.mp3"
-            self._audio_layers.append(mv.layer.media.Audio(file_path))
-        for i in range(len(self.conversation)):
-            file_path = path + f"{self.video_name}_aud_{'{:02d}'.format(i)}.mp3"
-            self._audio_layers.append(mv.layer.media.Audio(file_path))
+        file_paths = [path + f"{self.video_name}_aud_intro.mp3"] if self.intro_message else []
+        file_paths += [path + f"{self.video_name}_aud_{'{:02d}'.format(i)}.mp3" for i in range(len(self.conversation))]
+        for file_path in file_paths:
+            self._audio_files.append(file_path)
+            self._audio_durations.append(audio_metadata_cache.get_duration(file_path))
 
     def get_duration(self, pause_duration: Optional[float] = 1.0) -> float:
         duration = tts_settings['end_delay']  # adding 3s for the end
-        for audio in self._audio_layers:
-            duration += audio.duration + pause_duration
+        for audio_duration in self._audio_durations:
+            duration += audio_duration + pause_duration
         return duration
 
-    def generate_image_layers(self, path: str, use_generated_captures: Optional[bool] = False) -> None:
-        if not use_generated_captures:
-            screen_gen = ScreenGenerator(self.conversation)
-            screen_gen.save_captures(path + f'{self.video_name}_capt_')
+    def get_start_times(self, pause_duration: Optional[float] = 1.0) -> List[float]:
+        """
+        Calculate the time at which each audio starts, on the timeline of `get_duration`
+        :param pause_duration: delay btw each audio files
+        :return: start time of each audio in seconds
+        """
+
+        start_times = []
+        time_stamp = 0.0
+        for audio_duration in self._audio_durations:
+            start_times.append(time_stamp)
+            time_stamp += audio_duration + pause_duration
+        return start_times
+
+    def generate_audio_track(
+            self,
+            pause_duration: Optional[float] = 1.0,
+            background_music_file: Optional[Union[None, str]] = tts_settings['background_music_folder'],
+            background_music_level: Optional[int] = -10
+    ) -> np.ndarray:
+        """
+        Mixes the audio files and the background music in a single track. Each file is decoded once, and the track is
+        given to the composition as a single audio layer, instead of one layer per file mixed by movis
+        :param pause_duration: delay btw each audio files
+        :param background_music_file: background music name folder. To not use music, set the param to None.
+        :param background_music_level: level of background music in decibels
+        :return: the track, float32 with a shape of (2, N)
+        """
+
+        total_duration = self.get_duration(pause_duration)
+        clips = [(mv.layer.media.Audio(file_path).audio, start_time, 0.0)
+                 for file_path, start_time in zip(self._audio_files, self.get_start_times(pause_duration))]
+        if background_music_file:
+            music = mv.layer.media.Audio(background_music_file + random.choice(os.listdir(background_music_file))).audio
+            # starts 0.5s in the music and stops 0.5s before the end of the video
+            clips.append((music[:, :int(total_duration * AUDIO_SAMPLING_RATE)], -0.5, background_music_level))
+        return mix_audio(clips, total_duration)
+
+    def generate_capture_files(self, path: str, capture_workers: Optional[int] = 1) -> None:
+        """
+        Generate the PNG files of the intro and of each capture, to be used later with use_generated_captures
+        :param path: the path to the folder of the video
+        :param capture_workers: number of processes rendering the captures. Defaults to 1
+        :return: None
+        """
+
+        if self.intro_message:
+            Intro_Image(self.intro_message).save(path + f"{self.video_name}_capt_intro.png", compress_level=1)
+        screen_gen = ScreenGenerator(self.conversation, workers=capture_workers)
+        screen_gen.save_captures(path + f'{self.video_name}_capt_', compress_level=1)
+
+    def generate_image_layers(
+            self,
+            path: str,
+            use_generated_captures: Optional[bool] = False,
+            save_captures: Optional[bool] = False,
+            capture_workers: Optional[int] = 1,
+            smooth_scroll: Optional[bool] = False
+    ) -> None:
+        """
+        Generate the image layers of the intro and of each capture. The rendered images are given directly to the
+        layers, the PNG files are only written if save_captures is true.
+        :param path: the path to the folder of the video
+        :param use_generated_captures: if true, the captures are read from the PNG files of a previous run
+        :param save_captures: if true, the captures are also saved as PNG files (fast compression)
+        :param capture_workers: number of processes rendering the captures. Defaults to 1
+        :param smooth_scroll: if true, only the intro layer is generated, the messages are shown by a `ScrollLayer`
+        :return: None
+        """
+
+        if use_generated_captures:
+            if self.intro_message:
+                self._image_layers.append(mv.layer.media.Image(path + f"{self.video_name}_capt_intro.png"))
+            for i in range(len(self.conversation)):
+                file_path = path + f"{self.video_name}_capt_{'{:02d}'.format(i)}.png"
+                self._image_layers.append(mv.layer.media.Image(file_path))
+            return
+
         if self.intro_message:
             intro_gen = Intro_Image(self.intro_message)
-            intro_gen.save(path + f"{self.video_name}_capt_intro.png")
-            self._image_layers.append(mv.layer.media.Image(path + f"{self.video_name}_capt_intro.png"))
-        for i in range(len(self.conversation)):
-            file_path = path + f"{self.video_name}_capt_{'{:02d}'.format(i)}.png"
-            self._image_layers.append(mv.layer.media.Image(file_path))
+            if save_captures:
+                intro_gen.save(path + f"{self.video_name}_capt_intro.png", compress_level=1)
+            self._image_layers.append(mv.layer.media.Image(intro_gen.canvas))
+
+        if smooth_scroll:
+            self._screen_gen = ScreenGenerator(self.conversation, prepare_captures=False)
+            return
+
+        screen_gen = ScreenGenerator(self.conversation, workers=capture_workers)
+        capture_path = path + f'{self.video_name}_capt_' if save_captures else None
+        for image in screen_gen.render_captures(capture_path, compress_level=1):
+            self._image_layers.append(mv.layer.media.Image(image))
 
     def generate_video(
             self,
@@ -190,7 +576,12 @@ class VideoGenerator:
             background_music_level: Optional[int] = -10,
             use_generated_audios: Optional[bool] = False,
             use_generated_captures: Optional[bool] = False,
-            use_background_video: Optional[bool] = True
+            use_background_video: Optional[bool] = True,
+            save_captures: Optional[bool] = False,
+            capture_workers: Optional[int] = 1,
+            smooth_scroll: Optional[bool] = False,
+            scroll_duration: Optional[float] = 0.3,
+            constant_frame_rate: Optional[bool] = True
     ):
         """
         Generates the video
@@ -200,13 +591,25 @@ class VideoGenerator:
         :param background_music_file: background music name folder. To not use music, set the param to None.
         :param use_generated_audios: if true, there will not be any TTS generation.
         :param use_generated_captures: if true, there will not be any capture generation.
-        :param use_background_video: use an animated background
+        :param use_background_video: use an animated background. Without it, each distinct frame is rendered once (see
+        `write_video_segments`)
+        :param save_captures: if true, the captures are also saved as PNG files, to be used later with
+        use_generated_captures
+        :param capture_workers: number of processes rendering the captures. Defaults to 1
+        :param smooth_scroll: if true, the conversation scrolls to each new message instead of cutting to the next
+        capture. Not used with use_generated_captures
+        :param scroll_duration: duration of the scroll to a new message, in seconds
+        :param constant_frame_rate: without background video, encode a constant frame rate video. Else the distinct
+        frames are encoded once in a variable frame rate video (see `write_video_segments`)
         :return: None
         """
+        smooth_scroll = smooth_scroll and not use_generated_captures
         if (not use_generated_captures) and (not use_generated_audios):
             os.mkdir(os.path.join(path, self.video_name))
         print('VideoGenerator INFO: generating image layers')
-        self.generate_image_layers(path + self.video_name + '/', use_generated_captures=use_generated_captures)
+        self.generate_image_layers(path + self.video_name + '/', use_generated_captures=use_generated_captures,
+                                   save_captures=save_captures, capture_workers=capture_workers,
+                                   smooth_scroll=smooth_scroll)
         print('\nVideoGenerator INFO: generating audio layers')
         self._audio_files_generated = use_generated_audios
         self.generate_audio_layers(path + self.video_name + '/')
@@ -217,60 +620,110 @@ class VideoGenerator:
         intro_scene = mv.layer.Composition(size=(1080, 1920), duration=total_duration)
 
         if use_background_video:
-            bg_video = mv.layer.media.Video('./Ressources/satisfying background.mp4', audio=False)
-            scene_background.add_layer(bg_video, scale=2.666, offset=-int(random.randrange(20, 250)))
-            super_scene.add_layer(scene_background, offset=0)
-
-        time_stamp: float = 0.0
-        for i, image_layer in enumerate(self._image_layers):
+            if video_settings['background_video_cache_directory']:
+                # the frames already have the size of the video, no need of a background composition
+                bg_video = BackgroundVideoCache.get(video_settings['background_video'],
+                                                    scale=video_settings['background_video_scale'],
+                                                    cache_directory=video_settings['background_video_cache_directory'])
+                super_scene.add_layer(bg_video, offset=-bg_video.random_offset(total_duration))
+            else:
+                bg_video = mv.layer.media.Video(video_settings['background_video'], audio=False)
+                scene_background.add_layer(bg_video, scale=video_settings['background_video_scale'],
+                                           offset=-int(random.randrange(*video_settings['background_video_offsets'])))
+                super_scene.add_layer(scene_background, offset=0)
+
+        message_times: List[float] = []
+        for i, time_stamp in enumerate(self.get_start_times(pause_duration)):
+            image_layer = self._image_layers[i] if i < len(self._image_layers) else None
             if i == 0 and self.intro_message:  # The intro image
-                intro_scene.add_layer(image_layer, offset=time_stamp, end_time=time_stamp + self._audio_layers[i].duration + pause_duration)
-                intro_scene.add_layer(self._audio_layers[i], offset=time_stamp)
+                intro_scene.add_layer(image_layer, offset=time_stamp, end_time=time_stamp + self._audio_durations[i] + pause_duration)
+            elif smooth_scroll:  # The images are replaced by the scroll layer
+                message_times.append(time_stamp)
             elif i == len(self._image_layers) - 1:  # The last image, adding delay at the end
-                scene_message.add_layer(image_layer, offset=time_stamp, end_time=time_stamp + self._audio_layers[i].duration + pause_duration + tts_settings['end_delay'])
-                scene_message.add_layer(self._audio_layers[i], offset=time_stamp)
+                scene_message.add_layer(image_layer, offset=time_stamp, end_time=time_stamp + self._audio_durations[i] + pause_duration + tts_settings['end_delay'])
             else:
-                scene_message.add_layer(image_layer, offset=time_stamp, end_time=time_stamp + self._audio_layers[i].duration + pause_duration)
-                scene_message.add_layer(self._audio_layers[i], offset=time_stamp)
+                scene_message.add_layer(image_layer, offset=time_stamp, end_time=time_stamp + self._audio_durations[i] + pause_duration)
 
-            time_stamp += self._audio_layers[i].duration + pause_duration
+        if smooth_scroll and message_times:
+            scroll_layer = ScrollLayer(self._screen_gen.get_strip(), self._screen_gen.get_chrome(),
+                                       [t - message_times[0] for t in message_times],
+                                       total_duration - message_times[0], scroll_duration=scroll_duration)
+            scene_message.add_layer(scroll_layer, offset=message_times[0])
 
-        if background_music_file:
-            bg_music_layer = mv.layer.media.Audio(background_music_file + random.choice(os.listdir(background_music_file)))
-            scene_message.add_layer(bg_music_layer, end_time=total_duration, audio_level=background_music_level, offset=-0.5)
+        print('VideoGenerator INFO: mixing audio')
+        audio_track = self.generate_audio_track(pause_duration, background_music_file, background_music_level)
+        super_scene.add_layer(mv.layer.media.Audio(audio_track), name='audio')
 
         if not use_background_video:
             super_scene.add_layer(intro_scene, name='intro')
             super_scene.add_layer(scene_message, name='msg')
         else:
             super_scene.add_layer(intro_scene, name='intro')
-            super_scene.add_layer(scene_message,scale=0.7, name='msg', opacity=0.9)
-            keyframes, values = generate_rotation_frames(total_duration, cycle_time=1.5)
-            super_scene['msg'].rotation.enable_motion().extend(
-                keyframes=keyframes.tolist(),
-                values=values.tolist(),
-                easings=None
-            )
-            keyframes, values = generate_scale_frames(total_duration, cycle_time=3, base_scale=0.8)
-            super_scene['msg'].scale.enable_motion().extend(
-                keyframes=keyframes.tolist(),
-                values=values.tolist(),
-                easings=None
-            )
-
-        super_scene.write_video(path + self.video_name + '.mp4')
+            # the rotation and scale motions, with the transformed frames cached
+            message_layer = TransformCache(scene_message,
+                                           generate_rotation_frames(total_duration, cycle_time=1.5),
+                                           generate_scale_frames(total_duration, cycle_time=3, base_scale=0.8))
+            super_scene.add_layer(message_layer, name='msg', opacity=0.9)
+
+        if use_background_video:
+            super_scene.write_video(path + self.video_name + '.mp4')
+            print(f'VideoGenerator INFO: {message_layer.misses} message scene frames transformed')
+        else:  # the frames change only with the messages
+            write_video_segments(super_scene, path + self.video_name + '.mp4',
+                                 constant_frame_rate=constant_frame_rate)
+
+
+def _run_with_cache_entries(func: Callable, *args, **kwargs) -> Tuple[Any, Tuple, Tuple]:
+    """
+    Runs a function in a worker process, and returns the entries it added to `metrics_cache` and
+    `audio_metadata_cache` with its hits and misses, so that the parent process can save them and log the right hit
+    rate (see `_merge_cache_entries`)
+    :return: result of the function, (new entries, hits, misses) of metrics_cache and of audio_metadata_cache
+    """
+
+    caches = (metrics_cache, audio_metadata_cache)
+    # entries inherited from the parent or sent back after a previous task
+    for cache in caches:
+        cache.pop_new_entries()
+    counters = [(cache.hits, cache.misses) for cache in caches]
+    result = func(*args, **kwargs)
+    return result, *[(cache.pop_new_entries(), cache.hits - hits, cache.misses - misses)
+                     for cache, (hits, misses) in zip(caches, counters)]
+
+
+def _merge_cache_entries(metrics: Tuple, audio: Tuple) -> None:
+    metrics_cache.update(*metrics)
+    audio_metadata_cache.update(*audio)
 
 
 class BatchVideoGeneratorFromFile:
     """
     Video rendering interface using conversations from a file.
-    File format: List[Dict['intro': Union[none, str], 'conversation': List[bool, str], 'uuid': UUID]] in JSON format
+    The conversations are stored in a `ConversationStore` (conv_store). The first time, the conversations of conv_file
+    (old format: List[Dict['intro': Union[none, str], 'conversation': List[bool, str], 'uuid': UUID]] in JSON
+    format) are imported in it.
+    The text measures are loaded from metrics_cache_file and saved in it after a batch. To not use it, set it to None.
+    The same goes for the durations of the audio files and audio_metadata_file.
+    Conversations are claimed in claim_directory before being rendered, so several batches can run at the same time.
     """
     def __init__(
             self,
-            conv_file: Optional[str] = './Ressources/conversations.txt'
+            conv_file: Optional[str] = './Ressources/conversations.txt',
+            metrics_cache_file: Optional[Union[None, str]] = './data/metrics_cache.json',
+            audio_metadata_file: Optional[Union[None, str]] = './data/audio_metadata.json',
+            claim_directory: Optional[str] = './data/claims/',
+            conv_store: Optional[str] = './Ressources/conversations.db'
     ):
         self.conv_file: str = conv_file
+        self.conversations: ConversationStore = ConversationStore(conv_store, import_path=conv_file)
+        self.metrics_cache_file: Optional[str] = metrics_cache_file
+        self.audio_metadata_file: Optional[str] = audio_metadata_file
+        self.claim_directory: str = claim_directory
+
+        if self.metrics_cache_file and os.path.isfile(self.metrics_cache_file):
+            metrics_cache.load(self.metrics_cache_file)
+        if self.audio_metadata_file and os.path.isfile(self.audio_metadata_file):
+            audio_metadata_cache.load(self.audio_metadata_file)
 
     def add_conversation(self):
         print("Enter/Paste your content.")
@@ -295,28 +748,177 @@ class BatchVideoGeneratorFromFile:
             title = None
 
         dico = {"intro": title, "conversation": contents, "uuid": str(id)}
-        conv_list = []
-        if os.path.isfile(self.conv_file):
-            with open(self.conv_file, 'r', encoding="utf-8") as f:
-                conv_list = json.load(f)
-        conv_list.append(dico)
+        self.conversations.add(dico)
 
-        with open(self.conv_file, 'w', encoding="utf-8") as f:
-            json.dump(conv_list, f, ensure_ascii=False)
-
-    def generate_videos(self, max: int = 10, **kwargs):
-        stats = read_stats('./data/stat.txt')
-        conversations_data = read_stats(self.conv_file)[0]
+    def generate_videos(self, max: int = 10, emoji_prefetch: bool = True, **kwargs):
+        if emoji_prefetch:
+            prefetch_emojis(self.conversations.iter_unused(stats_store), background_standard_options['name_list_path'])
 
         count = 0
-        conv_num = 0
+        conversations_data = self.conversations.iter_unused(stats_store)
         while count < max:
-            if conv_num >= len(conversations_data):
+            conv_data = next(conversations_data, None)
+            if conv_data is None:
                 print('not enough conversations stored')
                 break
-            conv_data = conversations_data[conv_num]
-            if not is_used(stats, conv_data["uuid"]):
+            if claim_conversation(self.claim_directory, conv_data["uuid"]):
                 vidGen = VideoGenerator("vid"+str(count), conv_data["conversation"], intro_message=conv_data["intro"], conversation_uuid=conv_data["uuid"])
-                vidGen.generate_video(**kwargs)
+                try:
+                    vidGen.generate_video(**kwargs)
+                except BaseException:  # also interrupted, the conversation can be rendered by another batch
+                    release_conversation(self.claim_directory, conv_data["uuid"])
+                    raise
                 count += 1
-            conv_num += 1
+
+        if self.metrics_cache_file:
+            metrics_cache.save(self.metrics_cache_file)
+        if self.audio_metadata_file:
+            audio_metadata_cache.save(self.audio_metadata_file)
+
+    def generate_videos_pipelined(
+            self,
+            max: int = 10,
+            emoji_prefetch: bool = True,
+            path: Optional[str] = './Generated/',
+            tts_workers: Optional[int] = 2,
+            capture_workers: Optional[int] = 2,
+            encode_workers: Optional[int] = 2,
+            queue_size: Optional[int] = 2,
+            **kwargs
+    ):
+        """
+        Generates the videos in a pipeline of three stages running at the same time on different videos: TTS (threads),
+        capture rendering (process pool) and composition/encoding (process pool). The stages are linked by bounded
+        queues, so a slow stage makes the previous ones wait. Videos are named after the uuid of their conversation.
+        If the batch is interrupted, the videos not being rendered yet are released. The text measures and the audio
+        durations computed by the processes are sent back to be saved.
+        :param max: number of videos to generate
+        :param emoji_prefetch: if true, the emojis of the conversations are downloaded first
+        :param path: the path to the result folder
+        :param tts_workers: number of videos whose audio files are generated at the same time
+        :param capture_workers: number of processes rendering captures
+        :param encode_workers: number of processes composing and encoding videos
+        :param queue_size: maximum number of videos waiting between two stages
+        :param kwargs: other parameters of `VideoGenerator.generate_video`
+        :return: None
+        """
+
+        if emoji_prefetch:
+            prefetch_emojis(self.conversations.iter_unused(stats_store), background_standard_options['name_list_path'])
+
+        capture_pool = ProcessPoolExecutor(max_workers=capture_workers)
+        encode_pool = ProcessPoolExecutor(max_workers=encode_workers)
+        # the processes are started before the stage threads
+        for pool in (capture_pool, encode_pool):
+            pool.submit(int).result()
+
+        def tts(vid_gen: VideoGenerator) -> VideoGenerator:
+            os.makedirs(path + vid_gen.video_name, exist_ok=True)
+            vid_gen.generate_audio_files(path + vid_gen.video_name + '/')
+            return vid_gen
+
+        def capture(vid_gen: VideoGenerator) -> VideoGenerator:
+            _merge_cache_entries(*capture_pool.submit(_run_with_cache_entries, vid_gen.generate_capture_files,
+                                                      path + vid_gen.video_name + '/').result()[1:])
+            return vid_gen
+
+        def encode(vid_gen: VideoGenerator) -> VideoGenerator:
+            _merge_cache_entries(*encode_pool.submit(_run_with_cache_entries, vid_gen.generate_video, path=path,
+                                                     use_generated_audios=True, use_generated_captures=True,
+                                                     **kwargs).result()[1:])
+            print('BatchVideoGenerator INFO: video done', vid_gen.video_name)
+            return vid_gen
+
+        tts_queue = queue.Queue(maxsize=queue_size)
+        capture_queue = queue.Queue(maxsize=queue_size)
+        encode_queue = queue.Queue(maxsize=queue_size)
+        stopping = threading.Event()  # set when the batch is interrupted, the waiting videos are released
+        stages = [
+            self._start_stage('tts', tts, tts_workers, tts_queue, capture_queue, capture_workers, stopping),
+            self._start_stage('capture', capture, capture_workers, capture_queue, encode_queue, encode_workers,
+                              stopping),
+            self._start_stage('encode', encode, encode_workers, encode_queue, stopping=stopping),
+        ]
+
+        try:
+            count = 0
+            for conv_data in self.conversations.iter_unused(stats_store):
+                if count >= max:
+                    break
+                if claim_conversation(self.claim_directory, conv_data["uuid"]):
+                    vid_gen = VideoGenerator("vid_" + str(conv_data["uuid"]), conv_data["conversation"],
+                                             intro_message=conv_data["intro"], conversation_uuid=conv_data["uuid"])
+                    try:
+                        tts_queue.put(vid_gen)
+                    except BaseException:
+                        release_conversation(self.claim_directory, conv_data["uuid"])
+                        raise
+                    count += 1
+            if count < max:
+                print('not enough conversations stored')
+        except BaseException:
+            stopping.set()
+            raise
+        finally:
+            # the stage threads are not daemons, they always have to be stopped
+            for _ in range(tts_workers):
+                tts_queue.put(None)
+            for stage in stages:
+                stage.join()
+            capture_pool.shutdown(cancel_futures=stopping.is_set())
+            encode_pool.shutdown(cancel_futures=stopping.is_set())
+
+        if self.metrics_cache_file:
+            metrics_cache.save(self.metrics_cache_file)
+        if self.audio_metadata_file:
+            audio_metadata_cache.save(self.audio_metadata_file)
+
+    def _start_stage(
+            self,
+            name: str,
+            func: Callable[[VideoGenerator], VideoGenerator],
+            workers: int,
+            in_queue: queue.Queue,
+            out_queue: Optional[queue.Queue] = None,
+            next_workers: Optional[int] = 0,
+            stopping: Optional[threading.Event] = None
+    ) -> threading.Thread:
+        """
+        Starts a stage of the pipeline: workers threads take videos from in_queue, process them with func and put them
+        in out_queue. A None item stops a thread. When all the threads are stopped, a None item is sent to each thread
+        of the next stage. If func fails, or if stopping is set, the conversation is released and the video is dropped.
+        :return: the thread to join to wait for the end of the stage
+        """
+
+        def work():
+            while True:
+                vid_gen = in_queue.get()
+                if vid_gen is None:
+                    break
+                if stopping is not None and stopping.is_set():
+                    release_conversation(self.claim_directory, vid_gen.conversation_uuid)
+                    continue
+                try:
+                    vid_gen = func(vid_gen)
+                except Exception as e:
+                    print(f'BatchVideoGenerator ERROR: {name} failed for {vid_gen.video_name}:', repr(e))
+                    release_conversation(self.claim_directory, vid_gen.conversation_uuid)
+                    continue
+                except BaseException:
+                    release_conversation(self.claim_directory, vid_gen.conversation_uuid)
+                    raise
+                if out_queue is not None:
+                    out_queue.put(vid_gen)
+
+        def supervise():
+            threads = [threading.Thread(target=work, name=f'{name}-{i}') for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for _ in range(next_workers):
+                out_queue.put(None)
+
+        supervisor = threading.Thread(target=supervise, name=name)
+        supervisor.start()
+        return supervisor
@@ -1,9 +1,29 @@
+import hashlib
 import json
+import math
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import threading
 import time
+from contextlib import contextmanager
 from datetime import date
-from typing import List, Tuple, Optional, Union, Dict
+from email.utils import parsedate_to_datetime
+from typing import Any, List, Tuple, Optional, Union, Dict, Iterator, Iterable
 import requests
+import requests.adapters
 import numpy as np
+import cv2
+import imageio
+import imageio_ffmpeg
+import soundfile as sf
+from movis.layer.protocol import AUDIO_SAMPLING_RATE
+from PIL import Image
+from utils import PersistentLRUCache
 
 
 
@@ -13,9 +33,305 @@ tts_settings = {
     'eleven_api_url': 'https://api.elevenlabs.io/v1/text-to-speech/',
     'background_music_folder': 'Ressources/sounds/',
     'end_delay': 3.0,
+    'max_concurrent_requests': 4,  # TTS requests in flight
+    'requests_per_second': 1.0,  # average rate of TTS requests
+    'requests_burst': 2,  # number of TTS requests that can be sent at once after a pause
+    'model_id': 'eleven_multilingual_v2',
+    'voice_settings': {
+        'stability': 0.5,
+        'similarity_boost': 0.7,
+        'style': 0.5
+    },
+    'audio_cache_directory': './data/tts_cache/',  # set to None to not use the cache
+    'audio_cache_max_bytes': 500 * 1024 * 1024,
 }
 
 
+class AudioCache:
+    """
+    Directory of already synthesized audio files, named by a hash of the request (text, voice, model and settings).
+    The least recently used files are removed when the directory exceeds max_bytes. Files are written atomically so
+    that several processes can share the directory.
+
+    :param directory: path to the cache directory
+    :param max_bytes: maximum total size of the cached files
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock: threading.Lock = threading.Lock()  # the requests of a video are sent by several threads
+
+    @staticmethod
+    def make_key(text: str, voice_id: str, model_id: str, voice_settings: Dict) -> str:
+        """
+        Returns the key of a TTS request
+        :return: hexadecimal sha256 of the request
+        """
+
+        request = json.dumps([text, voice_id, model_id, voice_settings], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the path of a cached file, and marks it as recently used
+        :param key: key of the request
+        :return: path to the file, or None if it is not cached
+        """
+
+        path = os.path.join(self.directory, key + '.mp3')
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, key: str, source_path: str) -> None:
+        """
+        Copies a file in the cache, then removes the least recently used files if the cache is too big
+        :param key: key of the request
+        :param source_path: path of the file to cache
+        :return: None
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, key + '.mp3')
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Removes the least recently used files until the cache is smaller than max_bytes
+        :return: None
+        """
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.mp3'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:  # already removed by another process
+                pass
+            total -= size
+
+    def hit_rate(self) -> float:
+        """
+        Returns the proportion of requests found in the cache
+        :return: hit rate (0-1)
+        """
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+tts_audio_cache: Optional[AudioCache] = None
+if tts_settings['audio_cache_directory']:
+    tts_audio_cache = AudioCache(tts_settings['audio_cache_directory'], tts_settings['audio_cache_max_bytes'])
+
+
+# MPEG audio layer III: bitrates in kbit/s by bitrate index, sample rates by version (3: MPEG-1, 2: MPEG-2, 0: MPEG-2.5)
+_MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _parse_mp3_header(data: bytes, i: int) -> Optional[Tuple[int, int, int, int, int]]:
+    """
+    Parses the header of a MPEG layer III frame
+    :param data: the bytes
+    :param i: position of the header
+    :return: version, bitrate in bit/s, sample rate, number of channels and length of the frame in bytes, or None if
+    it is not a valid header
+    """
+
+    if i + 4 > len(data) or data[i] != 0xFF or data[i + 1] & 0xE0 != 0xE0:
+        return None
+    version = (data[i + 1] >> 3) & 3
+    layer = (data[i + 1] >> 1) & 3
+    bitrate_index = data[i + 2] >> 4
+    sample_rate_index = (data[i + 2] >> 2) & 3
+    if version == 1 or layer != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = _MP3_BITRATES[3 if version == 3 else 2][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][sample_rate_index]
+    channels = 1 if data[i + 3] >> 6 == 3 else 2
+    padding = (data[i + 2] >> 1) & 1
+    frame_length = (144 if version == 3 else 72) * bitrate // sample_rate + padding
+    return version, bitrate, sample_rate, channels, frame_length
+
+
+def probe_mp3(path: str) -> Optional[Dict[str, Union[float, int]]]:
+    """
+    Reads the duration of a mp3 file from its headers, without decoding it. The number of frames is read from the
+    Xing/Info or VBRI header, with the encoder delay and padding of the LAME tag, like a gapless decoder. Without them,
+    the file is considered constant bitrate.
+    :param path: path to the file
+    :return: duration in seconds, sample rate and number of channels, or None if it is not a mp3 file
+    """
+
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        data = f.read(10)
+        start = 0
+        if data[:3] == b'ID3' and len(data) == 10:  # ID3v2 tag, its size is a synchsafe integer
+            start = 10 + ((data[6] & 0x7F) << 21 | (data[7] & 0x7F) << 14 | (data[8] & 0x7F) << 7 | (data[9] & 0x7F))
+            if data[5] & 0x10:  # footer
+                start += 10
+        f.seek(start)
+        data = f.read(64 * 1024)
+        f.seek(max(size - 128, 0))
+        has_id3v1 = f.read(3) == b'TAG'
+
+    # first frame header, followed by another frame header
+    i = 0
+    header = None
+    while i < len(data) - 4:
+        header = _parse_mp3_header(data, i)
+        if header is not None and (i + header[4] + 4 > len(data) or _parse_mp3_header(data, i + header[4])):
+            break
+        header = None
+        i = data.find(b'\xff', i + 1)
+        if i < 0:
+            break
+    if header is None:
+        return None
+    version, bitrate, sample_rate, channels, frame_length = header
+    samples_per_frame = 1152 if version == 3 else 576
+
+    frames = None
+    delay = padding = 0
+    side_info = (32 if channels == 2 else 17) if version == 3 else (17 if channels == 2 else 9)
+    xing = i + 4 + side_info
+    if data[xing:xing + 4] in (b'Xing', b'Info'):
+        flags = int.from_bytes(data[xing + 4:xing + 8], 'big')
+        position = xing + 8
+        if flags & 1:
+            frames = int.from_bytes(data[position:position + 4], 'big')
+            position += 4
+        position += 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+        if position + 24 <= i + frame_length:  # LAME tag, the encoder name can also be 'Lavc' for ffmpeg
+            delay_padding = int.from_bytes(data[position + 21:position + 24], 'big')
+            delay, padding = delay_padding >> 12, delay_padding & 0xFFF
+    elif data[i + 36:i + 40] == b'VBRI':
+        frames = int.from_bytes(data[i + 50:i + 54], 'big')
+
+    if frames:
+        samples = frames * samples_per_frame - delay - padding
+        duration = samples / sample_rate
+    else:
+        audio_bytes = size - start - i - 128 * has_id3v1
+        duration = audio_bytes * 8 / bitrate
+    return {'duration': duration, 'sample_rate': sample_rate, 'channels': channels}
+
+
+def probe_audio(path: str) -> Dict[str, Union[float, int]]:
+    """
+    Reads the duration of an audio file from its headers, see `probe_mp3`. The other formats are read with soundfile
+    :param path: path to the file
+    :return: duration in seconds, sample rate and number of channels
+    """
+
+    metadata = probe_mp3(path) if path.lower().endswith('.mp3') else None
+    if metadata is None:
+        info = sf.info(path)
+        metadata = {'duration': info.duration, 'sample_rate': info.samplerate, 'channels': info.channels}
+    return metadata
+
+
+class AudioMetadataCache(PersistentLRUCache):
+    """
+    `PersistentLRUCache` of the metadata of audio files (see `probe_audio`), keyed by (path, size, mtime), so a file
+    rewritten is probed again. It lets the timeline of a video be planned without decoding its audio files.
+    """
+
+    def get_metadata(self, path: str) -> Dict[str, Union[float, int]]:
+        """
+        Returns the metadata of an audio file, probed the first time
+        :param path: path to the file
+        :return: duration in seconds, sample rate and number of channels
+        """
+
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        metadata = self._get(key)
+        if metadata is None:
+            metadata = probe_audio(path)
+            self._set(key, metadata)
+        return metadata
+
+    def get_duration(self, path: str) -> float:
+        """
+        Returns the duration of an audio file, probed the first time
+        :param path: path to the file
+        :return: duration in seconds
+        """
+
+        return self.get_metadata(path)['duration']
+
+
+# metadata of the TTS files and of the background music
+audio_metadata_cache: AudioMetadataCache = AudioMetadataCache()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter. Each request takes one token, the tokens are refilled at a given rate up
+    to the capacity of the bucket.
+
+    :param rate: number of tokens added per second
+    :param capacity: maximum number of tokens in the bucket
+    """
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate: float = rate
+        self.capacity: int = capacity
+
+        self._tokens: float = capacity
+        self._last_refill: float = time.monotonic()
+        self._lock: threading.Lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """
+        Takes a token, waits until one is available if needed
+        :return: None
+        """
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# shared by all the TTS requests of the process
+tts_rate_limiter: TokenBucket = TokenBucket(tts_settings['requests_per_second'], tts_settings['requests_burst'])
+tts_request_slots: threading.BoundedSemaphore = threading.BoundedSemaphore(tts_settings['max_concurrent_requests'])
+
+
 def conversation_validation(conversation: List) -> bool:
     """
     Visualize the conversation before validation
@@ -61,21 +377,25 @@ def conversation_character_counter(conv: List[Tuple[bool, str]]) -> int:
     return total
 
 
-def save_characters(path: str, conv: List[Tuple[bool, str]], conv_uuid: Union[str, int], intro_message: Optional[Union[None, str]] = None) -> None:
+def save_characters(path: Optional[str], conv: List[Tuple[bool, str]], conv_uuid: Union[str, int], intro_message: Optional[Union[None, str]] = None, cached_characters: Optional[int] = 0) -> None:
     """
-    save the number of char of a conversation in a file
+    save the number of char of a conversation in `stats_store`
     :param conv_uuid: uuid of conversation. If it's not relevant, use 0 instead.
     :param intro_message: the string of the intro image. If left empty it will not be used. Defaults to None.
-    :param path: where to save
+    :param path: JSONL file (old format) where the stat is also appended. None to only use the store
     :param conv: conversation
+    :param cached_characters: number of characters taken from the TTS cache, they are not counted. Defaults to 0.
     :return: none
     """
 
     intro_length = 0
     if intro_message: intro_length = character_counter_string(intro_message)
-    to_save = {"date": date.today().isoformat(), "length": conversation_character_counter(conv) + intro_length, "uuid": conv_uuid}
-    with open(path, "a") as f:
-        f.write(json.dumps(to_save) + "\n")
+    length = conversation_character_counter(conv) + intro_length - cached_characters
+    to_save = {"date": date.today().isoformat(), "length": length, "cached": cached_characters, "uuid": conv_uuid}
+    stats_store.add(to_save)
+    if path:
+        with open(path, "a") as f:
+            f.write(json.dumps(to_save) + "\n")
 
 
 def read_stats(path: str) -> List[Dict]:
@@ -99,35 +419,523 @@ def is_used(stats: List[Dict], id: Union[str, int]) -> bool:
     return False
 
 
-def send_request(url, json_data, headers):
-    response = None
-    wait = True
-    while wait:
-        print('TextGenHelper send_request INFO: Sending request...')
-        response = requests.post(url, json=json_data, headers=headers)
-        if response.status_code == 429:
-            print('TextGenHelper send_request ERROR: 429, retrying in 10s...')
-            time.sleep(10)
-        elif response.status_code != 200:
-            print('TextGenHelper send_request ERROR:', response.status_code)
-            raise Exception
+class SQLiteStore:
+    """
+    Base of the SQLite stores. The database is created on first use with the statements of SCHEMA, then the file
+    import_path (old storage format) is imported in it by `import_file`. Several processes can use the same database.
+
+    :param path: path to the SQLite database
+    :param import_path: path to the file to import when the database is created. Optional
+    """
+
+    SCHEMA: List[str] = []
+
+    def __init__(self, path: str, import_path: Optional[str] = None) -> None:
+        self.path: str = path
+        self.import_path: Optional[str] = import_path
+        self._initialized: bool = False
+
+    def import_file(self, path: str) -> int:
+        """
+        Imports a file of the old storage format
+        :param path: path to the file
+        :return: number of imported items
+        """
+
+        with self._connect() as conn:
+            return self._import(conn, path)
+
+    def _import(self, conn: sqlite3.Connection, path: str) -> int:
+        """
+        Imports a file of the old storage format with a connection, in its current transaction
+        :param conn: the connection
+        :param path: path to the file
+        :return: number of imported items
+        """
+
+        raise NotImplementedError
+
+    @contextmanager
+    def _connect(self):
+        self._ensure_initialized()
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _ensure_initialized(self) -> None:
+        if not self._initialized:
+            self._initialize()
+
+    def _initialize(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # the other processes wait for the end of the import, and a failed import is not marked as imported
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+                conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+                # only the process creating the database imports the old file. The database is marked as imported even
+                # without file, so a file written later is not imported
+                if self.import_path and conn.execute(
+                        "INSERT OR IGNORE INTO meta (key, value) VALUES ('imported', ?)", (self.import_path,)).rowcount \
+                        and os.path.isfile(self.import_path):
+                    self._import(conn, self.import_path)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+        self._initialized = True
+
+
+class StatsStore(SQLiteStore):
+    """
+    SQLite store of the stats, indexed by uuid, so that checking if a conversation is used does not read the whole
+    stats file. Several processes can add stats at the same time. The stats of import_path (JSONL file written by
+    the old `save_characters`) are imported when the database is created.
+    """
+
+    SCHEMA: List[str] = [
+        'CREATE TABLE IF NOT EXISTS stats (uuid TEXT, date TEXT, length INTEGER, cached INTEGER)',
+        'CREATE INDEX IF NOT EXISTS stats_uuid ON stats (uuid)',
+    ]
+
+    def add(self, stat: Dict) -> None:
+        """
+        Adds a stat
+        :param stat: dict with keys "date", "length", "uuid" and optionally "cached"
+        :return: None
+        """
+
+        with self._connect() as conn:
+            conn.execute('INSERT INTO stats (uuid, date, length, cached) VALUES (?, ?, ?, ?)',
+                         (str(stat["uuid"]), stat["date"], stat["length"], stat.get("cached", 0)))
+
+    def is_used(self, id: Union[str, int]) -> bool:
+        """
+        Checks if a conversation has already been used
+        :param id: uuid of the conversation
+        :return: bool
+        """
+
+        with self._connect() as conn:
+            return conn.execute('SELECT 1 FROM stats WHERE uuid = ? LIMIT 1', (str(id),)).fetchone() is not None
+
+    def _import(self, conn: sqlite3.Connection, path: str) -> int:
+        """
+        Imports the stats of a JSONL stats file
+        :param conn: the connection
+        :param path: path to the stats file
+        :return: number of imported stats
+        """
+
+        stats = read_stats(path)
+        conn.executemany('INSERT INTO stats (uuid, date, length, cached) VALUES (?, ?, ?, ?)',
+                         [(str(stat["uuid"]), stat.get("date"), stat.get("length"), stat.get("cached", 0))
+                          for stat in stats])
+        print(f'StatsStore INFO: {len(stats)} stats imported from {path}')
+        return len(stats)
+
+
+class ConversationStore(SQLiteStore):
+    """
+    SQLite store of the conversations, indexed by uuid. Adding a conversation does not rewrite the others, and the
+    unused conversations are read page by page. The conversations of import_path (JSON list written by the old
+    `BatchVideoGeneratorFromFile.add_conversation`) are imported when the database is created.
+    Conversation format: Dict['intro': Union[None, str], 'conversation': List[Tuple[bool, str]], 'uuid': str]
+    """
+
+    SCHEMA: List[str] = [
+        'CREATE TABLE IF NOT EXISTS conversations (id INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT UNIQUE, '
+        'intro TEXT, conversation TEXT)',
+    ]
+
+    def add(self, conv_data: Dict) -> None:
+        """
+        Adds a conversation. A conversation whose uuid is already stored is ignored
+        :param conv_data: the conversation
+        :return: None
+        """
+
+        self.add_many([conv_data])
+
+    def add_many(self, conversations: List[Dict]) -> int:
+        """
+        Adds conversations. Conversations whose uuid is already stored are ignored
+        :param conversations: the conversations
+        :return: number of added conversations
+        """
+
+        with self._connect() as conn:
+            return self._insert_many(conn, conversations)
+
+    def get(self, id: Union[str, int]) -> Optional[Dict]:
+        """
+        Returns a conversation from its uuid
+        :param id: uuid of the conversation
+        :return: the conversation, or None if it is not stored
+        """
+
+        with self._connect() as conn:
+            row = conn.execute('SELECT id, uuid, intro, conversation FROM conversations WHERE uuid = ?',
+                               (str(id),)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def iter_conversations(self, page_size: Optional[int] = 100) -> Iterator[Dict]:
+        """
+        Iterates over all the conversations, in the order they were added. They are read page by page
+        :param page_size: number of conversations read at once
+        :return: iterator of conversations
+        """
+
+        last_id = 0
+        while True:
+            with self._connect() as conn:
+                rows = conn.execute('SELECT id, uuid, intro, conversation FROM conversations WHERE id > ? '
+                                    'ORDER BY id LIMIT ?', (last_id, page_size)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._to_dict(row)
+            last_id = rows[-1][0]
+
+    def iter_unused(self, stats: StatsStore, page_size: Optional[int] = 100) -> Iterator[Dict]:
+        """
+        Iterates over the conversations that are not used in the stats, in the order they were added. The stats
+        database is attached to the connection, so the used conversations are filtered out by SQLite page by page
+        :param stats: the stats store
+        :param page_size: number of conversations read at once
+        :return: iterator of conversations
+        """
+
+        stats._ensure_initialized()
+        last_id = 0
+        with self._connect() as conn:
+            conn.execute('ATTACH DATABASE ? AS used', (stats.path,))
+            while True:
+                rows = conn.execute('SELECT id, uuid, intro, conversation FROM conversations AS c WHERE id > ? '
+                                    'AND NOT EXISTS (SELECT 1 FROM used.stats WHERE uuid = c.uuid) '
+                                    'ORDER BY id LIMIT ?', (last_id, page_size)).fetchall()
+                if not rows:
+                    return
+                for row in rows:
+                    yield self._to_dict(row)
+                last_id = rows[-1][0]
+
+    def _import(self, conn: sqlite3.Connection, path: str) -> int:
+        """
+        Imports the conversations of a JSON list file
+        :param conn: the connection
+        :param path: path to the conversations file
+        :return: number of imported conversations
+        """
+
+        with open(path, 'r', encoding='utf-8') as f:
+            conversations = json.load(f)
+        count = self._insert_many(conn, conversations)
+        print(f'ConversationStore INFO: {count} conversations imported from {path}')
+        return count
+
+    @staticmethod
+    def _insert_many(conn: sqlite3.Connection, conversations: List[Dict]) -> int:
+        cursor = conn.executemany(
+            'INSERT OR IGNORE INTO conversations (uuid, intro, conversation) VALUES (?, ?, ?)',
+            [(str(conv_data["uuid"]), conv_data["intro"], json.dumps(conv_data["conversation"], ensure_ascii=False))
+             for conv_data in conversations])
+        return cursor.rowcount
+
+    @staticmethod
+    def _to_dict(row: Tuple) -> Dict:
+        return {"intro": row[2], "conversation": json.loads(row[3]), "uuid": row[1]}
+
+
+stats_store: StatsStore = StatsStore('./data/stats.db', import_path='./data/stat.txt')
+
+
+def claim_conversation(
+        claim_directory: str,
+        id: Union[str, int],
+        max_age: Optional[float] = 24 * 3600
+) -> bool:
+    """
+    Claims a conversation before rendering it, so that two workers never render the same one. The claim is a file
+    created atomically in claim_directory, holding the host and the pid of the process. A claim left by a process that
+    died (interrupted or killed) is stale and taken over, see `remove_stale_claim`.
+    :param claim_directory: directory of the claims, shared by all the workers
+    :param id: uuid of the conversation
+    :param max_age: age in seconds after which a claim of another host is stale. Defaults to 24h
+    :return: True if the conversation has been claimed, False if it was already claimed
+    """
+
+    os.makedirs(claim_directory, exist_ok=True)
+    path = os.path.join(claim_directory, str(id))
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not remove_stale_claim(path, max_age):
+                return False
+            continue
+        os.write(fd, f'{socket.gethostname()} {os.getpid()}'.encode())
+        os.close(fd)
+        return True
+    return False
+
+
+def remove_stale_claim(path: str, max_age: Optional[float] = 24 * 3600) -> bool:
+    """
+    Removes a claim if the process that created it is dead. The pid can only be checked on the same host, the claims
+    of another host are stale after max_age.
+    :param path: path to the claim
+    :param max_age: age in seconds after which a claim of another host is stale
+    :return: True if the claim does not exist anymore
+    """
+
+    try:
+        with open(path, 'r') as f:
+            content = f.read()
+        age = time.time() - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return True
+    host, _, pid = content.partition(' ')
+    if host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+            return False
+        except ProcessLookupError:
+            pass
+        except PermissionError:  # process of another user
+            return False
+    elif age < max_age:  # also a claim being written, without its pid yet
+        return False
+
+    # renamed first, so that a claim created again in the meantime by another process is not removed
+    stale_path = f'{path}.{os.getpid()}.{threading.get_ident()}.stale'
+    try:
+        os.rename(path, stale_path)
+    except FileNotFoundError:
+        return True
+    with open(stale_path, 'r') as f:
+        renamed = f.read()
+    if renamed != content:
+        try:
+            os.link(stale_path, path)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    print(f'INFO: stale claim {path} removed')
+    return True
+
+
+def release_conversation(claim_directory: str, id: Union[str, int]) -> None:
+    """
+    Removes the claim of a conversation, for example after a failed rendering
+    :param claim_directory: directory of the claims
+    :param id: uuid of the conversation
+    :return: None
+    """
+
+    try:
+        os.remove(os.path.join(claim_directory, str(id)))
+    except FileNotFoundError:
+        pass
+
+
+ollama_settings = {
+    'url': 'http://localhost:11434/api/generate',
+}
+
+
+http_settings = {
+    'pool_size': 10,  # connections kept alive per host
+    'connect_timeout': 10.0,
+    'read_timeout': 120.0,
+    'max_retries': 6,
+    'backoff_base': 1.0,  # first retry delay in seconds, doubled at each retry
+    'backoff_max': 60.0,
+}
+
+
+class RequestError(Exception):
+    """
+    Raised when an HTTP request fails with a status that is not retried, or after all the retries
+
+    :param status_code: the last HTTP status, None if the request did not get a response
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None) -> None:
+        super().__init__(message)
+        self.status_code: Optional[int] = status_code
+
+
+class RetriesExhaustedError(RequestError):
+    """
+    Raised when a request still fails after http_settings['max_retries'] retries
+    """
+
+
+_session: Optional[requests.Session] = None
+_session_lock: threading.Lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by all the requests of the process, keeping the connections alive
+    :return: the session
+    """
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=http_settings['pool_size'],
+                                                    pool_maxsize=http_settings['pool_size'])
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def get_retry_delay(attempt: int, response: Optional[requests.Response] = None) -> float:
+    """
+    Returns the delay before retrying a request: the Retry-After header of the response if there is one, else an
+    exponential backoff with jitter
+    :param attempt: number of the retry, starting at 0
+    :param response: the response of the failed request, optional
+    :return: delay in seconds
+    """
+
+    if response is not None and response.headers.get('Retry-After'):
+        retry_after = response.headers['Retry-After']
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                retry_date = parsedate_to_datetime(retry_after)
+                return max(0.0, retry_date.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    delay = min(http_settings['backoff_max'], http_settings['backoff_base'] * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _post(
+        url: str,
+        json_data: dict,
+        headers: Optional[dict],
+        stream: bool,
+        retry_read_timeouts: Optional[bool] = False
+) -> requests.Response:
+    """
+    Sends a POST request with the shared session. Connection errors, connect timeouts, 429 and 5xx are retried.
+    :param retry_read_timeouts: if true, read timeouts are retried too. A read timeout happens after the request was
+    sent, so only set it for requests that can be sent twice (the billed TTS requests can not). Defaults to False
+    :return: the response, with status 200
+    """
+
+    session = get_session()
+    timeout = (http_settings['connect_timeout'], http_settings['read_timeout'])
+    for attempt in range(http_settings['max_retries'] + 1):
+        response = None
+        try:
+            response = session.post(url, json=json_data, headers=headers, stream=stream, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            print('TextGenHelper send_request ERROR:', e.__class__.__name__)
+            status_code = None
+            # ConnectTimeout is a ConnectionError, ReadTimeout is not: the request may have been processed
+            if not retry_read_timeouts and not isinstance(e, requests.ConnectionError):
+                raise RequestError(f'{url} timed out after the request was sent') from e
         else:
-            # print('TextGenHelper send_request INFO: Request successfull (200)')
-            wait = False
+            if response.status_code == 200:
+                return response
+            status_code = response.status_code
+            response.close()
+            if status_code != 429 and status_code < 500:
+                print('TextGenHelper send_request ERROR:', status_code)
+                raise RequestError(f'{url} returned {status_code}', status_code)
+
+        if attempt == http_settings['max_retries']:
+            break
+        delay = get_retry_delay(attempt, response)
+        print(f'TextGenHelper send_request ERROR: {status_code}, retrying in {delay:.1f}s...')
+        time.sleep(delay)
+
+    raise RetriesExhaustedError(f'{url} failed after {http_settings["max_retries"]} retries', status_code)
 
-    return response
+
+def send_request(url, json_data, headers):
+    print('TextGenHelper send_request INFO: Sending request...')
+    return _post(url, json_data, headers, stream=False)
 
 
 def send_request_stream(url: str, json_data: dict):
-    response_text = ''
-    s = requests.Session()
+    response_text = ''.join(iter_request_stream(url, json_data))
+    # print("TextGenHelper send_request_stream INFO: request done.")
+    return response_text
+
+
+def iter_request_stream(url: str, json_data: dict) -> Iterator[str]:
+    """
+    Sends a request to a streaming endpoint (NDJSON, like Ollama's /api/generate) and yields the text fragments as
+    they arrive. Closing the generator closes the connection, which stops the generation.
+    :param url: url of the endpoint
+    :param json_data: body of the request
+    :return: iterator of text fragments
+    """
+
     print("TextGenHelper send_request_stream INFO: sending request.")
-    with s.post(url, json=json_data, headers=None, stream=True) as res:
+    with _post(url, json_data, None, stream=True, retry_read_timeouts=True) as res:
         for line in res.iter_lines():
             if line:
-                response_text += json.loads(line.decode("UTF-8"))["response"]
-    # print("TextGenHelper send_request_stream INFO: request done.")
-    return response_text
+                yield json.loads(line.decode("UTF-8"))["response"]
+
+
+def iter_text_lines(fragments: Iterable[str]) -> Iterator[str]:
+    """
+    Yields the complete lines of a text received in fragments, as soon as each line is complete
+    :param fragments: iterator of text fragments
+    :return: iterator of lines, without the return
+    """
+
+    pending = []
+    for fragment in fragments:
+        *lines, rest = fragment.split('\n')
+        if lines:
+            pending.append(lines[0])
+            yield ''.join(pending)
+            yield from lines[1:]
+            pending = []
+        if rest:
+            pending.append(rest)
+    if pending:
+        yield ''.join(pending)
+
+
+def parse_replica(line: str) -> Optional[Tuple[bool, str]]:
+    """
+    Parses a line of a generated conversation ('A: ...' or 'B: ...')
+    :param line: the line
+    :return: the replica (True for B), or None if the line is not a replica
+    """
+
+    if line[:2] == 'A:':
+        return False, line[3:]
+    elif line[:3] == 'A :':
+        return False, line[4:]
+    elif line[:2] == 'B:':
+        return True, line[3:]
+    elif line[:3] == 'B :':
+        return True, line[4:]
+    return None
 
 
 def format_text(text_to_format: Union[str, List]) -> List:
@@ -138,20 +946,224 @@ def format_text(text_to_format: Union[str, List]) -> List:
     res = []
 
     for line in split:
-        if line[:2] == 'A:':
-            res.append((False, line[3:]))
-        elif line[:3] == 'A :':
-            res.append((False, line[4:]))
-        elif line[:2] == 'B:':
-            res.append((True, line[3:]))
-        elif line[:3] == 'B :':
-            res.append((True, line[4:]))
+        replica = parse_replica(line)
+        if replica is not None:
+            res.append(replica)
         else:
             print('ERROR: format text impossible')
             print(line[:3])
     return res
 
 
+video_settings = {
+    'transform_angle_step': 0.25,  # degrees, rotations of the message scene are rounded to it. 0 to not round
+    'transform_scale_step': 0.005,  # scales of the message scene are rounded to it. 0 to not round
+    'transform_cache_max_bytes': 512 * 1024 * 1024,  # memory used by the transformed frames of the message scene
+    'background_video': './Ressources/satisfying background.mp4',
+    'background_video_scale': 2.666,
+    # directory of the scaled frames of the background video (see BackgroundVideoCache), e.g. './data/video_cache/'.
+    # Each 1080*1920 frame takes ~8MB of disk: ~15GB per minute of a 30 fps background. None to decode and scale the
+    # background video in each video
+    'background_video_cache_directory': None,
+    'background_video_offsets': (20, 250),  # range of the random start of the background video, in seconds
+}
+
+
+class BackgroundVideoCache:
+    """
+    movis layer showing a background video already scaled (around its center, like the scale of a movis layer) and
+    cropped to the size of the video. The video is decoded and scaled once, and its RGBA frames are stored in a raw
+    .npy file of cache_directory. The file is memory mapped, so the frames are read without a copy and shared by the
+    videos and the processes through the page cache. The file is invalidated when the size or the mtime of the source
+    changes. Use `BackgroundVideoCache.get` to share the layers in a process, and an offset in the composition to
+    start at a random time.
+
+    :param source: path of the background video
+    :param size: size of the frames. Defaults to 1080*1920
+    :param scale: scale of the source video. Defaults to 2.666
+    :param cache_directory: directory of the scaled frames
+    """
+
+    _layers: Dict[Tuple[str, Tuple[int, int], float, str], 'BackgroundVideoCache'] = {}
+    _layers_lock: threading.Lock = threading.Lock()
+
+    def __init__(
+            self,
+            source: str,
+            size: Optional[Tuple[int, int]] = (1080, 1920),
+            scale: Optional[float] = video_settings['background_video_scale'],
+            cache_directory: Optional[str] = video_settings['background_video_cache_directory']
+    ) -> None:
+        self.source: str = source
+        self.size: Tuple[int, int] = tuple(size)
+        self.scale: float = scale
+        self.cache_directory: str = cache_directory
+
+        stat = os.stat(source)
+        self.cache_path: str = os.path.join(cache_directory, f'{self._get_prefix()}{stat.st_size}.{stat.st_mtime_ns}.npy')
+        if not os.path.isfile(self.cache_path + '.json'):
+            self._build_once()
+        with open(self.cache_path + '.json', 'r') as f:
+            meta = json.load(f)
+        self.fps: float = meta['fps']
+        # the file can hold a few frames more than decoded, never written
+        self.frames: np.ndarray = np.load(self.cache_path, mmap_mode='r')[:meta['frames']]
+        self.duration: float = len(self.frames) / self.fps
+
+    @classmethod
+    def get(
+            cls,
+            source: str,
+            size: Optional[Tuple[int, int]] = (1080, 1920),
+            scale: Optional[float] = video_settings['background_video_scale'],
+            cache_directory: Optional[str] = video_settings['background_video_cache_directory']
+    ) -> 'BackgroundVideoCache':
+        """
+        Gives the layer of a background video, created the first time or when the source changed
+        :param source: path of the background video
+        :param size: size of the frames
+        :param scale: scale of the source video
+        :param cache_directory: directory of the scaled frames
+        :return: the layer
+        """
+
+        key = (source, tuple(size), scale, cache_directory)
+        with cls._layers_lock:
+            layer = cls._layers.get(key)
+            stat = os.stat(source)
+            if layer is None or not layer.cache_path.endswith(f'.{stat.st_size}.{stat.st_mtime_ns}.npy'):
+                layer = cls._layers[key] = cls(source, size, scale, cache_directory)
+        return layer
+
+    def random_offset(self, duration: float, offsets: Optional[Tuple[float, float]] = None) -> float:
+        """
+        Chooses a random start in the background video, so that it lasts for the given duration if possible
+        :param duration: duration of the video using the background
+        :param offsets: range of the start in seconds. Defaults to video_settings['background_video_offsets']
+        :return: the start, in seconds
+        """
+
+        low, high = offsets if offsets is not None else video_settings['background_video_offsets']
+        high = min(high, self.duration - duration)
+        if high <= low:
+            return max(high, 0)
+        return random.uniform(low, high)
+
+    def get_key(self, time: float) -> int:
+        if time < 0 or self.duration <= time:
+            return -1
+        return int(time * self.fps)
+
+    def __call__(self, time: float) -> Optional[np.ndarray]:
+        index = self.get_key(time)
+        if index < 0 or index >= len(self.frames):
+            return None
+        return self.frames[index]
+
+    def _get_prefix(self) -> str:
+        return f'{os.path.basename(self.source)}.{self.size[0]}x{self.size[1]}.{self.scale:g}.'
+
+    def _build_once(self) -> None:
+        """
+        Builds the cache file if no other process is building it, else waits for it. The builder holds a lock file
+        created atomically, with its host and pid like a claim, so the lock of a dead builder is removed
+        :return: None
+        """
+
+        os.makedirs(self.cache_directory, exist_ok=True)
+        lock_path = self.cache_path + '.lock'
+        while not os.path.isfile(self.cache_path + '.json'):
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not remove_stale_claim(lock_path, max_age=3600):
+                    time.sleep(1)
+                continue
+            try:
+                os.write(fd, f'{socket.gethostname()} {os.getpid()}'.encode())
+                os.close(fd)
+                if not os.path.isfile(self.cache_path + '.json'):
+                    self._build()
+            finally:
+                os.remove(lock_path)
+
+    def _build(self) -> None:
+        """
+        Decodes and scales the source video into the cache file, then removes the outdated versions. The file is sized
+        from the duration in the metadata, counting the frames would decode the video twice, and the number of frames
+        actually decoded is saved with the fps
+        :return: None
+        """
+
+        print(f'BackgroundVideoCache INFO: scaling {self.source}')
+        reader = imageio.get_reader(self.source)
+        try:
+            meta = reader.get_meta_data()
+            fps = meta['fps']
+            n_frames = meta.get('nframes', math.inf)
+            if not math.isfinite(n_frames):
+                n_frames = math.ceil(meta['duration'] * fps) + 1
+            tmp_path = f'{self.cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                               shape=(n_frames, self.size[1], self.size[0], 4))
+            decoded = 0
+            for frame in reader:
+                if decoded >= n_frames:
+                    break
+                frames[decoded] = self._scale_frame(cv2.cvtColor(frame, cv2.COLOR_RGB2RGBA), self.size, self.scale)
+                decoded += 1
+            frames.flush()
+            del frames
+        finally:
+            reader.close()
+        if not decoded:
+            os.remove(tmp_path)
+            raise RuntimeError(f'{self.source}: no frame decoded')
+
+        prefix = self._get_prefix()
+        current = os.path.basename(self.cache_path)
+        for file in os.listdir(self.cache_directory):
+            # versions of other sizes or mtimes of the source
+            if file.startswith(prefix) and file.endswith(('.npy', '.npy.json')) and not file.startswith(current):
+                try:
+                    os.remove(os.path.join(self.cache_directory, file))
+                except OSError:
+                    pass
+        os.replace(tmp_path, self.cache_path)
+        # written last, a cache file without it is incomplete
+        tmp_path = f'{self.cache_path}.json.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'fps': fps, 'frames': decoded}, f)
+        os.replace(tmp_path, self.cache_path + '.json')
+
+    @staticmethod
+    def _scale_frame(source: np.ndarray, size: Tuple[int, int], scale: float) -> np.ndarray:
+        """
+        Scales a frame around its center and places it at the center of a frame of the given size, with the same affine
+        matrix, bounds and interpolation as movis
+        :param source: the RGBA frame
+        :param size: size of the result
+        :param scale: scale
+        :return: the scaled frame
+        """
+
+        h, w = source.shape[:2]
+        matrix = np.array([[scale, 0, size[0] / 2 - scale * w / 2], [0, scale, size[1] / 2 - scale * h / 2]])
+        corners = np.array([[0, 0, 1], [0, h, 1], [w, 0, 1], [w, h, 1]], dtype=np.float64) @ matrix.transpose()
+        x0, y0 = np.ceil(corners.min(axis=0)).astype(int)
+        x1, y1 = np.floor(corners.max(axis=0)).astype(int)
+        fixed = matrix - np.array([[0, 0, x0], [0, 0, y0]])
+        scaled = cv2.warpAffine(source, fixed, dsize=(int(x1 - x0), int(y1 - y0)), flags=cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT)
+
+        frame = np.zeros((size[1], size[0], 4), dtype=np.uint8)
+        fx0, fy0 = max(x0, 0), max(y0, 0)
+        fx1, fy1 = min(x1, size[0]), min(y1, size[1])
+        if fx0 < fx1 and fy0 < fy1:
+            frame[fy0:fy1, fx0:fx1] = scaled[fy0 - y0:fy1 - y0, fx0 - x0:fx1 - x0]
+        return frame
+
+
 def generate_rotation_frames(duration: float, cycle_time: Optional[float] = 1) -> Tuple[np.ndarray, np.ndarray]:
     """
     Generates the animation data (keyframes and value)
@@ -181,3 +1193,87 @@ def generate_scale_frames(duration: float, cycle_time: Optional[float] = 4, base
 
     return keyframes, values
 
+
+def mix_audio(clips: Iterable[Tuple[np.ndarray, float, float]], duration: float) -> np.ndarray:
+    """
+    Mixes audio clips in a single track, like the audio of a movis composition with one layer per clip
+    :param clips: audio (shape (2, N), sampled at AUDIO_SAMPLING_RATE), offset in seconds (negative to skip the start of
+    the clip) and level in decibels of each clip
+    :param duration: duration of the track in seconds, the clips are cut at the end
+    :return: the track, float32 with a shape of (2, duration * AUDIO_SAMPLING_RATE)
+    """
+
+    track = np.zeros((2, int(duration * AUDIO_SAMPLING_RATE)), dtype=np.float32)
+    for audio, offset, level in clips:
+        start = int(offset * AUDIO_SAMPLING_RATE)
+        skip = max(-start, 0)
+        start = max(start, 0)
+        length = min(audio.shape[1] - skip, track.shape[1] - start)
+        if length <= 0:
+            continue
+        if level:
+            track[:, start:start + length] += audio[:, skip:skip + length] * np.float32(10.0 ** (level / 20.0))
+        else:
+            track[:, start:start + length] += audio[:, skip:skip + length]
+    return track
+
+
+def write_video_segments(
+        composition: Any,
+        dst_file: str,
+        fps: Optional[float] = 30.0,
+        constant_frame_rate: Optional[bool] = True
+) -> int:
+    """
+    Writes a movis composition like `Composition.write_video`, but renders only once each range of frames where the
+    composition does not change (same movis key, so same image). Each distinct frame is given to ffmpeg once with its
+    duration, so the cost depends on the number of changes of the video instead of its number of frames.
+    :param composition: the movis composition
+    :param dst_file: path of the video
+    :param fps: frame rate of the video. Defaults to 30
+    :param constant_frame_rate: if true, ffmpeg repeats the frames to encode a constant frame rate video, like
+    `write_video` (the repeated frames are not rendered again, and are cheap to encode). Else each distinct frame is
+    encoded once in a variable frame rate video. Defaults to True
+    :return: number of distinct frames rendered
+    """
+
+    times = np.arange(0.0, composition.duration, 1.0 / fps)
+    segments = []  # [time of the first frame, number of frames]
+    last_key = None
+    for t in times:
+        key = composition.get_key(t)
+        if segments and key == last_key:
+            segments[-1][1] += 1
+        else:
+            segments.append([t, 1])
+            last_key = key
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        concat_lines = []
+        frame_path = ''
+        for i, (t, nb_frames) in enumerate(segments):
+            frame_path = os.path.join(temp_dir, f'{i:05d}.png')
+            # like ffmpeg with movis, the alpha channel is dropped
+            Image.fromarray(np.asarray(composition(t))[:, :, :3]).save(frame_path, compress_level=1)
+            concat_lines.append(f"file '{frame_path}'\nduration {nb_frames / fps}\n")
+        concat_lines.append(f"file '{frame_path}'\n")  # the duration of the last frame is used only if it is repeated
+        concat_path = os.path.join(temp_dir, 'frames.txt')
+        with open(concat_path, 'w') as f:
+            f.writelines(concat_lines)
+
+        command = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0',
+                   '-i', concat_path]
+        audio = composition.get_audio(0.0, composition.duration)
+        if audio is not None:
+            audio_path = os.path.join(temp_dir, 'audio.wav')
+            sf.write(audio_path, audio.transpose(), samplerate=AUDIO_SAMPLING_RATE, subtype='PCM_16')
+            command += ['-i', audio_path, '-c:a', 'aac']
+        if constant_frame_rate:
+            command += ['-vf', f'fps={fps}', '-frames:v', str(len(times))]
+        else:
+            command += ['-fps_mode', 'vfr']
+        command += ['-c:v', 'libx264', '-crf', '25', '-pix_fmt', 'yuv420p', str(dst_file)]  # like movis (imageio)
+        subprocess.run(command, check=True)
+
+    print(f'write_video_segments INFO: {len(segments)} distinct frames for {len(times)} frames')
+    return len(segments)
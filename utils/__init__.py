@@ -1,3 +1,3 @@
 from . import helpers
-from .core import Capture, MessageBox, ScreenGenerator, MessageArea, Intro_Image
+from .core import Capture, MessageBox, ScreenGenerator, MessageArea, MessageStrip, Intro_Image, get_chrome
 from .helpers import *
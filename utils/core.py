@@ -1,11 +1,18 @@
-import os
-import random
-from PIL import Image, ImageDraw
-from pilmoji import Pilmoji, getsize
-from pilmoji.source import AppleEmojiSource
-from typing import List, Tuple, Optional, Dict, Union
+import bisect
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+from pilmoji import Pilmoji
+from typing import List, Tuple, Optional, Dict, Union, Iterator
 from os import PathLike
-from .helpers import background_standard_options, format_text_box, choose_random_name, get_crop_region
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from .helpers import background_standard_options, format_text_box, choose_random_name, metrics_cache, GlyphAtlas, \
+    IntroBackgroundCache, load_background
+
+# Capture templates (background, name, avatar and time already drawn), see `Capture._add_chrome`
+CHROME_CACHE_SIZE: int = 16
+_chrome_cache: OrderedDict = OrderedDict()
 
 
 class Intro_Image:
@@ -28,16 +35,17 @@ class Intro_Image:
         self.draw_text()
 
     def add_background(self):
-        random_image = random.choice(os.listdir(self.background_path))
+        backgrounds = IntroBackgroundCache.get(self.background_path, self.canvas.size,
+                                               self.preset_options['intro_cache_directory'])
+        random_image = backgrounds.choose()
         print(random_image)
-        im = self.resize_image(random_image)
-        self.canvas.paste(im)
+        self.canvas.paste(backgrounds.get_background(random_image))
 
 
     def draw_text(self):
 
         self._create_draw()
-        text_size = getsize(self.intro_text, font=self.preset_options['intro_font'])
+        text_size = metrics_cache.get_size(self.intro_text, self.preset_options['intro_font'])
         self.draw.rounded_rectangle(
             [540 - text_size[0]/2 - self.preset_options['intro_text_background_padding'],
              960 - text_size[1]/2 - self.preset_options['intro_text_background_padding'],
@@ -48,27 +56,15 @@ class Intro_Image:
         )
         self._close_draw()
 
-        with Pilmoji(self.canvas, source=AppleEmojiSource, emoji_position_offset=(2, 8),
+        with Pilmoji(self.canvas, source=self.preset_options['emoji_source'], emoji_position_offset=(2, 8),
                      emoji_scale_factor=1) as pilmoji:
             pilmoji.text((540, 930), self.intro_text, fill=(0, 0, 0, 255), font=self.preset_options['intro_font'], anchor='md', align='center', stroke_fill=(255,255,255,255), stroke_width=10)
 
-    def save(self, path: str):
-        self.canvas.save(path)
+    def save(self, path: str, compress_level: Optional[int] = 6):
+        self.canvas.save(path, compress_level=compress_level)
 
     def resize_image(self, image_name):
-        with Image.open(self.background_path + image_name) as im:
-            original_size = im.size
-            if original_size[0]/original_size[1] < 9/16:  # image trop fine
-                scale = 1080/original_size[0]
-            else:  # trop large
-                scale = 1920/original_size[1]
-
-            # resize
-            resized = im.resize((int(scale*original_size[0]), int(scale*original_size[1])))
-
-        new_size = resized.size
-        cropped = resized.crop(get_crop_region(new_size))
-        return cropped
+        return load_background(self.background_path + image_name, self.canvas.size)
 
     def _create_draw(self) -> None:
         """
@@ -109,6 +105,9 @@ class Capture:
     :type emoji_in_name: bool, optional
     :param preset_options: The options of the preset, optional
     :param draw: the drawing context, optional
+    :param message_area: an already rendered MessageArea, optional
+    :param messages: already rendered MessageBox of the conversation. If given, the messages are not rendered again,
+    optional
     """
 
     def __init__(
@@ -121,6 +120,7 @@ class Capture:
             preset_options: Optional[Dict] = background_standard_options,
             draw: Optional[ImageDraw.ImageDraw] = None,
             message_area: Optional = None,
+            messages: Optional[List] = None,
     ) -> None:
         self._base_path: PathLike = base
         self._avatar_path: PathLike = avatar
@@ -134,7 +134,10 @@ class Capture:
         self._generated: bool = False
         self.messages: List[MessageBox] = []
 
-        self._import_messages()
+        if messages is None:
+            self._import_messages()
+        else:
+            self.messages = messages
         self.message_area: MessageArea = message_area
         self.canvas: Image.Image = Image.new('RGBA', (1080, 1920))
 
@@ -146,14 +149,32 @@ class Capture:
         """
 
         if not self._generated:
+            self._add_chrome()
+            self._add_messages(scroll)
+            self._generated = True
+        else:
+            print('capture already generated')
+
+    def _add_chrome(self) -> None:
+        """
+        Adds the background, the name, the avatar and the time. They are the same for every capture of a video, so
+        they are rendered once in a template shared by the captures with the same preset, name, time and avatar
+        :return: None
+        """
+
+        key = (id(self.preset_options), str(self._base_path), str(self._avatar_path), self.name, self.time)
+        chrome = _chrome_cache.get(key)
+        if chrome is None:
             self._add_background()
             self._add_name()
             self._add_avatar()
             self._add_time()
-            self._add_messages(scroll)
-            self._generated = True
+            _chrome_cache[key] = self.canvas.copy()
+            while len(_chrome_cache) > CHROME_CACHE_SIZE:
+                _chrome_cache.popitem(last=False)
         else:
-            print('capture already generated')
+            _chrome_cache.move_to_end(key)
+            self.canvas = chrome.copy()
 
     def _add_background(self) -> None:
         """
@@ -181,10 +202,10 @@ class Capture:
         :return: None
         """
 
-        with Pilmoji(self.canvas, source=AppleEmojiSource, emoji_position_offset=(2, 8),
+        with Pilmoji(self.canvas, source=self.preset_options['emoji_source'], emoji_position_offset=(2, 8),
                      emoji_scale_factor=1) as pilmoji:
             font = background_standard_options['name_font']
-            text_length, w = pilmoji.getsize(self.name, font=font)
+            text_length, w = metrics_cache.get_size(self.name, font)
             x_pos = 540 - (text_length // 2)
 
             pilmoji.text((x_pos, background_standard_options['name_y_position']), self.name, (0, 0, 0), font)
@@ -213,18 +234,24 @@ class Capture:
 
         self.canvas.paste(self.message_area.canvas, (0, y), self.message_area.canvas)
 
-    def save(self, path: Union[PathLike, str], scroll: Optional[float] = 1.0) -> None:
+    def save(
+            self,
+            path: Union[PathLike, str],
+            scroll: Optional[float] = 1.0,
+            compress_level: Optional[int] = 6
+    ) -> None:
         """
         Saves the capture into the specified path. Generate the capture if needed.
         :param scroll: scroll value (0-1). Optional, defaults to 1 and used if not generated.
         :param path: the path. PathLike object
+        :param compress_level: PNG compression level (0-9), 1 is the fastest. Defaults to 6
         :return: None
         """
 
         if not self._generated:
             self.generate(scroll)
 
-        self.canvas.save(path)
+        self.canvas.save(path, compress_level=compress_level)
 
     def _import_messages(self) -> None:
         """
@@ -260,11 +287,95 @@ class Capture:
             self._new_draw = False
 
 
+class BubbleSprite:
+    """
+    Nine-slice sprite of a message box background. The corners and the edges of a rounded rectangle are rasterized
+    once per colour and radius, a box of any size is then assembled by pasting them and filling the middle, which gives
+    the same pixels as `ImageDraw.rounded_rectangle`. Use `BubbleSprite.get` to share the sprites.
+    """
+
+    _sprites: Dict[Tuple[str, int], 'BubbleSprite'] = {}
+
+    def __init__(self, color: Union[str, Tuple[int, ...]], radius: int):
+        self.color: Tuple[int, ...] = ImageColor.getcolor(color, 'RGBA') if isinstance(color, str) else color
+        self.corner: int = int(radius) + 1  # size of the corner sprites
+
+        c = self.corner
+        reference = Image.new('RGBA', (2 * c + 1, 2 * c + 1))
+        ImageDraw.Draw(reference).rounded_rectangle([0, 0, 2 * c + 1, 2 * c + 1], radius=radius, fill=color)
+        # top left, top right, bottom right, bottom left
+        self.corners: List[Image.Image] = [reference.crop(box) for box in (
+            (0, 0, c, c), (c + 1, 0, 2 * c + 1, c), (c + 1, c + 1, 2 * c + 1, 2 * c + 1), (0, c + 1, c, 2 * c + 1))]
+        # top, right, bottom, left, one pixel long
+        self.edges: List[Image.Image] = [reference.crop(box) for box in (
+            (c, 0, c + 1, c), (c + 1, c, 2 * c + 1, c + 1), (c, c + 1, c + 1, 2 * c + 1), (0, c, c, c + 1))]
+        # usually the edges are plain, then only the corners are pasted over a filled box
+        self.plain_edges: bool = all(edge.getcolors() == [(c, self.color)] for edge in self.edges)
+
+    @classmethod
+    def get(cls, color: Union[str, Tuple[int, ...]], radius: int) -> 'BubbleSprite':
+        """
+        Gives the sprite of a colour and a radius, rasterized the first time
+        :param color: the colour of the box
+        :param radius: the radius of the corners
+        :return: the sprite
+        """
+
+        key = (color, radius)
+        sprite = cls._sprites.get(key)
+        if sprite is None:
+            sprite = cls._sprites[key] = cls(color, radius)
+        return sprite
+
+    def fits(self, size: Tuple[int, int]) -> bool:
+        """
+        Checks if a box can be assembled from the sprite. Smaller boxes have joined corners.
+        :param size: size of the box
+        :return: bool
+        """
+
+        return size[0] > 2 * self.corner and size[1] > 2 * self.corner
+
+    def draw(self, canvas: Image.Image, size: Tuple[int, int]) -> None:
+        """
+        Draws a box on the upper left of a canvas, like `rounded_rectangle([0, 0, *size])`
+        :param canvas: the RGBA canvas
+        :param size: size of the box, see `fits`
+        :return: None
+        """
+
+        w, h = size
+        c = self.corner
+        if self.plain_edges:
+            canvas.paste(self.color, (0, 0, w, h))
+        else:
+            canvas.paste(self.color, (c, c, w - c, h - c))
+            self._draw_edges(canvas, size)
+        for corner, position in zip(self.corners, ((0, 0), (w - c, 0), (w - c, h - c), (0, h - c))):
+            canvas.paste(corner, position)
+
+    def _draw_edges(self, canvas: Image.Image, size: Tuple[int, int]) -> None:
+        """
+        Draws the edges of a box by stretching the edge sprites
+        :param canvas: the RGBA canvas
+        :param size: size of the box
+        :return: None
+        """
+
+        w, h = size
+        c = self.corner
+        canvas.paste(self.edges[0].resize((w - 2 * c, c), Image.NEAREST), (c, 0))
+        canvas.paste(self.edges[1].resize((c, h - 2 * c), Image.NEAREST), (w - c, c))
+        canvas.paste(self.edges[2].resize((w - 2 * c, c), Image.NEAREST), (c, h - c))
+        canvas.paste(self.edges[3].resize((c, h - 2 * c), Image.NEAREST), (0, c))
+
+
 class MessageBox:
     """
     Rendering interface of a message box. Usually used by class `Capture`but can be used to generate a standalone
     image of the message box.
 
+    :param text_formatted: if true, message_text has already been formatted with `format_text_box`. Defaults to False
     """
 
     def __init__(
@@ -272,12 +383,16 @@ class MessageBox:
             message_text: str,
             receiving: bool,
             preset_options: Optional[Dict] = background_standard_options,
-            draw: Optional[ImageDraw.ImageDraw] = None
+            draw: Optional[ImageDraw.ImageDraw] = None,
+            text_formatted: Optional[bool] = False
     ):
         self.preset_options: Dict = preset_options
-        self.message_text: str = format_text_box(message_text, self.preset_options['message_max_width'],
-                                                 self.preset_options['message_font'])
-        self.text_size: Tuple[int, int] = getsize(self.message_text, font=self.preset_options['message_font'])
+        if text_formatted:
+            self.message_text: str = message_text
+        else:
+            self.message_text: str = format_text_box(message_text, self.preset_options['message_max_width'],
+                                                     self.preset_options['message_font'])
+        self.text_size: Tuple[int, int] = metrics_cache.get_size(self.message_text, self.preset_options['message_font'])
         self.box_size: Tuple[int, int] = (self.text_size[0] + 2 * self.preset_options['message_x_padding'],
                                           self.text_size[1] + 2 * self.preset_options['message_y_padding'])
         self.receiving: bool = receiving
@@ -291,17 +406,17 @@ class MessageBox:
         :return: None
         """
 
-        self._create_draw()
         if self.receiving:
-            self.draw.rounded_rectangle(
-                [0, 0, *self.box_size],
-                radius=self.preset_options['message_radius'],
-                fill=self.preset_options['message_background_color_receiving'])
+            color = self.preset_options['message_background_color_receiving']
         else:
-            self.draw.rounded_rectangle(
-                [0, 0, *self.box_size],
-                radius=self.preset_options['message_radius'],
-                fill=self.preset_options['message_background_color_sending'])
+            color = self.preset_options['message_background_color_sending']
+        sprite = BubbleSprite.get(color, self.preset_options['message_radius'])
+        if sprite.fits(self.box_size):
+            sprite.draw(self.canvas, self.box_size)
+            return
+
+        self._create_draw()
+        self.draw.rounded_rectangle([0, 0, *self.box_size], radius=self.preset_options['message_radius'], fill=color)
         self._close_draw()
 
     def draw_text(self) -> None:
@@ -309,16 +424,17 @@ class MessageBox:
         Draws the text of the message in the box
         :return: None
         """
-        if not self.receiving:
-            with Pilmoji(self.canvas, source=AppleEmojiSource, emoji_position_offset=(2, 8),
-                         emoji_scale_factor=1) as pilmoji:
-                pilmoji.text((self.preset_options['message_x_padding'], self.preset_options['message_y_padding'] - 10),
-                             self.message_text, fill=(255, 255, 255, 255), font=self.preset_options['message_font'])
-        else:
-            with Pilmoji(self.canvas, source=AppleEmojiSource, emoji_position_offset=(2, 8),
-                         emoji_scale_factor=1) as pilmoji:
-                pilmoji.text((self.preset_options['message_x_padding'], self.preset_options['message_y_padding'] - 10),
-                             self.message_text, fill=(0, 0, 0, 255), font=self.preset_options['message_font'])
+        fill = (0, 0, 0, 255) if self.receiving else (255, 255, 255, 255)
+        position = (self.preset_options['message_x_padding'], self.preset_options['message_y_padding'] - 10)
+        if self.preset_options['glyph_atlas']:
+            GlyphAtlas.get(self.preset_options['message_font']).draw_text(
+                self.canvas, position, self.message_text, fill, self.preset_options['emoji_source'],
+                emoji_position_offset=(2, 8), emoji_scale_factor=1)
+            return
+
+        with Pilmoji(self.canvas, source=self.preset_options['emoji_source'], emoji_position_offset=(2, 8),
+                     emoji_scale_factor=1) as pilmoji:
+            pilmoji.text(position, self.message_text, fill=fill, font=self.preset_options['message_font'])
 
     def get_message_box_x(self, message_x_margin: int) -> int:
         """
@@ -357,6 +473,8 @@ class MessageBox:
 class MessageArea:
     """
     Rendering the messages in this area. Using MessageBox class and used in Capture class
+    The top of each message is kept in a cumulative height index, so that only the messages overlapping the area are
+    drawn.
     """
 
     def __init__(
@@ -365,6 +483,7 @@ class MessageArea:
             scroll: Optional[float] = 1.0,
             preset_options: Optional[Dict] = background_standard_options,
             draw: Optional[ImageDraw.ImageDraw] = None,
+            previous_area: Optional['MessageArea'] = None,
     ):
         self.message_list: List[MessageBox] = message_list
         self.scroll: float = scroll
@@ -372,9 +491,15 @@ class MessageArea:
         self.draw: ImageDraw.ImageDraw = draw
 
         self._new_draw: bool = False
+        self._message_tops: List[int] = []  # y of the top of each message, scroll not included
+        self._message_bottoms: List[int] = []
+        self._index_messages()
         self._total_message_height: int = self.get_total_message_height()
         self.canvas: Image.Image = Image.new('RGBA', self.preset_options['message_area_size'])
-        self.add_messages()
+        if previous_area is not None and self._can_append_to(previous_area):
+            self.append_message(previous_area)
+        else:
+            self.add_messages()
 
     def add_messages(self) -> None:
         """
@@ -382,13 +507,82 @@ class MessageArea:
         :return: None
         """
 
-        y = -int(self.scroll * max(0, self._total_message_height - self.preset_options['message_area_size'][1])) + \
-            self.preset_options['message_y_margin']
+        offset = self.get_scroll_offset()
         print(f'\rMessageArea INFO: generation de l\'image: {len(self.message_list)}', end="")
-        for message in self.message_list:
+        first, last = self.get_visible_range(offset)
+        for i in range(first, last):
+            message = self.message_list[i]
             x = message.get_message_box_x(self.preset_options['message_x_margin'])
-            self.canvas.paste(message.canvas, (x, y), message.canvas)
-            y += message.box_size[1] + self.preset_options['message_y_margin']
+            self.canvas.paste(message.canvas, (x, self._message_tops[i] - offset), message.canvas)
+
+    def get_visible_range(self, offset: int) -> Tuple[int, int]:
+        """
+        Finds the messages overlapping the area for a given scroll offset, with a binary search in the index
+        :param offset: number of pixels hidden above the area
+        :return: index of the first visible message and index after the last one
+        """
+
+        first = bisect.bisect_right(self._message_bottoms, offset)
+        last = bisect.bisect_left(self._message_tops, offset + self.preset_options['message_area_size'][1])
+        return first, max(first, last)
+
+    def _index_messages(self) -> None:
+        """
+        Calculate the cumulative height index of the messages
+        :return: None
+        """
+
+        y = self.preset_options['message_y_margin']
+        for message in self.message_list:
+            self._message_tops.append(y)
+            y += message.box_size[1]
+            self._message_bottoms.append(y)
+            y += self.preset_options['message_y_margin']
+
+    def append_message(self, previous_area: 'MessageArea') -> None:
+        """
+        Draws the canvas from the canvas of a MessageArea containing all the messages but the last one: the previous
+        canvas is shifted by the scroll difference and only the new message is pasted
+        :param previous_area: the MessageArea of the previous capture
+        :return: None
+        """
+
+        shift = self.get_scroll_offset() - previous_area.get_scroll_offset()
+        self.canvas.paste(previous_area.canvas, (0, -shift))
+
+        message = self.message_list[-1]
+        x = message.get_message_box_x(self.preset_options['message_x_margin'])
+        y = previous_area._total_message_height - self.get_scroll_offset()
+        self.canvas.paste(message.canvas, (x, y), message.canvas)
+
+    def _can_append_to(self, previous_area: 'MessageArea') -> bool:
+        """
+        Checks if the canvas can be drawn from the canvas of a given MessageArea. It needs to hold the same messages
+        but the last one, and its canvas must not have cut the messages that are still visible.
+        :param previous_area: the MessageArea of the previous capture
+        :return: bool
+        """
+
+        if previous_area.preset_options is not self.preset_options:
+            return False
+        if len(previous_area.message_list) + 1 != len(self.message_list):
+            return False
+        if any(a is not b for a, b in zip(previous_area.message_list, self.message_list)):
+            return False
+
+        previous_offset = previous_area.get_scroll_offset()
+        area_height = self.preset_options['message_area_size'][1]
+        # messages above the previous viewport are lost, messages below it too
+        return self.get_scroll_offset() >= previous_offset and \
+            previous_area._total_message_height - previous_offset <= area_height
+
+    def get_scroll_offset(self) -> int:
+        """
+        Calculate the number of pixels hidden above the area because of the scroll
+        :return: offset, int
+        """
+
+        return int(self.scroll * max(0, self._total_message_height - self.preset_options['message_area_size'][1]))
 
     def get_total_message_height(self) -> int:
         """
@@ -396,15 +590,120 @@ class MessageArea:
         :return: total height, int
         """
 
-        h = self.preset_options['message_y_margin']
+        if not self.message_list:
+            return int(self.preset_options['message_y_margin'])
+        return int(self._message_bottoms[-1] + self.preset_options['message_y_margin'])
+
+
+class MessageStrip:
+    """
+    The whole message column rasterized once in a tall strip, used for smooth scrolling. Each frame shows a slice of
+    the strip (a view, not a copy) pasted on the capture template, so a scroll step costs about a copy of the frame
+    instead of a new MessageArea and Capture. A frame at the end of the scroll of the n first messages is the same as
+    the capture of these messages.
+    """
+
+    def __init__(
+            self,
+            message_list: List[MessageBox],
+            preset_options: Optional[Dict] = background_standard_options
+    ):
+        self.message_list: List[MessageBox] = message_list
+        self.preset_options: Dict = preset_options
+        y = self.preset_options['message_y_margin']
+        self._message_heights: List[int] = [y]  # height of the n first messages, margins included
+        tops = []
         for message in self.message_list:
-            h += message.box_size[1] + self.preset_options['message_y_margin']
-        return int(h)
+            tops.append(y)
+            y += message.box_size[1] + self.preset_options['message_y_margin']
+            self._message_heights.append(y)
+
+        canvas = Image.new('RGBA', (self.preset_options['message_area_size'][0], y))
+        for message, top in zip(self.message_list, tops):
+            x = message.get_message_box_x(self.preset_options['message_x_margin'])
+            canvas.paste(message.canvas, (x, top), message.canvas)
+        self.strip: np.ndarray = np.asarray(canvas)
+
+    def get_height(self, count: int) -> int:
+        """
+        Calculate the height of the n first messages, margins included
+        :param count: number of messages
+        :return: height, int
+        """
+
+        return self._message_heights[count]
+
+    def get_scroll_offset(self, count: int, scroll: Optional[float] = 1.0) -> int:
+        """
+        Calculate the number of pixels hidden above the area when the n first messages are shown
+        :param count: number of messages shown
+        :param scroll: scroll value (0-1) (defaults to 1)
+        :return: offset, int
+        """
+
+        return int(scroll * max(0, self.get_height(count) - self.preset_options['message_area_size'][1]))
+
+    def get_view(self, offset: int, count: Optional[int] = None) -> np.ndarray:
+        """
+        Gives the visible part of the strip. The messages after the n first ones are cut.
+        :param offset: number of pixels hidden above the area
+        :param count: number of messages shown. Defaults to all the messages
+        :return: a view of the strip, (height, width, 4) uint8
+        """
+
+        if count is None:
+            count = len(self.message_list)
+        bottom = min(offset + self.preset_options['message_area_size'][1], self.get_height(count))
+        return self.strip[offset:max(offset, bottom)]
+
+    def render_frame(self, chrome: Image.Image, offset: int, count: Optional[int] = None) -> Image.Image:
+        """
+        Pastes the visible part of the strip on a capture template
+        :param chrome: the capture template, see `get_chrome`
+        :param offset: number of pixels hidden above the area
+        :param count: number of messages shown. Defaults to all the messages
+        :return: the frame
+        """
+
+        frame = chrome.copy()
+        view = self.get_view(offset, count)
+        if len(view):
+            # the rows of the strip are contiguous, so the image shares the memory of the strip
+            area = Image.frombuffer('RGBA', (view.shape[1], view.shape[0]), view, 'raw', 'RGBA', 0, 1)
+            frame.paste(area, (0, self.preset_options['message_first_y']), area)
+        return frame
+
+
+def get_chrome(
+        preset: Optional[Dict] = background_standard_options,
+        name: Optional[str] = 'Antoine🥰',
+        time: Optional[str] = '21:48'
+) -> Image.Image:
+    """
+    Gives the capture template (background, name, avatar and time) of a conversation, from the cache if possible
+    :param preset: the options of the preset
+    :param name: the name of the interlocutor
+    :param time: the time to display
+    :return: the template, do not modify it
+    """
+
+    capture = Capture(preset['background_path'], preset['avatar_path'], [], name=name, time=time,
+                      preset_options=preset, messages=[])
+    capture._add_chrome()
+    return capture.canvas
 
 
 class ScreenGenerator:
     """
     Main interface to generate multiple screenshots of one conversation. Uses the Capture class
+
+    :param incremental: if true, each message box is rendered only once and shared by all the captures, and each
+    message area is drawn from the previous one. Defaults to True
+    :param workers: number of processes rendering the captures. If more than 1, the captures saved by
+    `render_captures` and `save_captures` are rendered in a process pool, each process rendering a range of captures
+    incrementally, and capture_list stays empty until `render_captures` renders captures in memory. Defaults to 1
+    :param prepare_captures: if false, capture_list stays empty, to only use `get_strip` and `get_chrome`. Defaults to
+    True
     """
 
     def __init__(
@@ -413,17 +712,28 @@ class ScreenGenerator:
             preset: Optional[Dict] = background_standard_options,
             name: Optional[str] = 'Antoine🥰',
             time: Optional[str] = '21:48',
+            incremental: Optional[bool] = True,
+            workers: Optional[int] = 1,
+            prepare_captures: Optional[bool] = True,
     ):
         self.conversation: List[Tuple[bool, str]] = conversation
         self.preset: Dict = preset
         self.name: str = name
         self.time: str = time
+        self.incremental: bool = incremental
+        self.workers: int = workers
         self.capture_list: List[Capture] = []
+        self.messages: List[MessageBox] = []
 
         if self.name == 'Antoine🥰' and self.preset['name_list_path']:
             self.name = choose_random_name(self.preset['name_list_path'])
 
-        self._add_captures()
+        if self.workers > 1 or not prepare_captures:
+            pass  # the captures are rendered by the workers, or not used
+        elif self.incremental:
+            self._add_captures_incremental()
+        else:
+            self._add_captures()
 
     def _add_captures(self) -> None:
         """
@@ -440,11 +750,282 @@ class ScreenGenerator:
                 preset_options=self.preset
             ))
 
-    def save_captures(self, path: str) -> None:
+    def _add_captures_incremental(self) -> None:
+        """
+        Adds captures to the capture list, rendering each message once. The message areas are drawn by appending the
+        new message to the previous area. Captures are not yet generated.
+        :return: None
+        """
+
+        self.messages = _render_message_boxes(self.conversation, self.preset)
+        self.capture_list.extend(_iter_incremental_captures(
+            self.conversation, self.messages, 0, len(self.conversation), self.preset, self.name, self.time))
+
+    def get_strip(self) -> MessageStrip:
+        """
+        Rasterizes the whole conversation in a strip, for smooth scrolling
+        :return: the strip of the messages
+        """
+
+        if not self.messages:
+            self.messages = _render_message_boxes(self.conversation, self.preset)
+        return MessageStrip(self.messages, self.preset)
+
+    def get_chrome(self) -> Image.Image:
+        """
+        Gives the capture template of the conversation
+        :return: the template, do not modify it
+        """
+
+        return get_chrome(self.preset, self.name, self.time)
+
+    def render_captures(self, path: Optional[str] = None, compress_level: Optional[int] = 6) -> List[Image.Image]:
+        """
+        Generates all the captures. With several workers, the process pool is only used if the captures are saved:
+        the workers write the PNG files and the images are read back from them, the in-memory captures are rendered
+        in this process, as sending them back from the workers costs more than rendering them.
+        :param path: if given, the captures are also saved in this path
+        :param compress_level: PNG compression level (0-9), 1 is the fastest. Defaults to 6
+        :return: the list of rendered images, in the order of the conversation
+        """
+
+        if self.workers > 1 and path is not None:
+            self._run_workers(path, compress_level)
+            images = []
+            for i in range(len(self.conversation)):
+                with Image.open(path + '{:02d}'.format(i) + '.png') as image:
+                    images.append(image.convert('RGBA'))
+            return images
+
+        if self.workers > 1 and not self.capture_list:
+            self._add_captures_incremental()
+
+        images = []
+        for i, capture in enumerate(self.capture_list):
+            if path is None:
+                if not capture._generated:
+                    capture.generate()
+            else:
+                capture.save(path + '{:02d}'.format(i) + '.png', compress_level=compress_level)
+            images.append(capture.canvas)
+        return images
+
+    def save_captures(self, path: str, compress_level: Optional[int] = 6) -> None:
         """
         Saves all the capture in a given path
+        :param compress_level: PNG compression level (0-9), 1 is the fastest. Defaults to 6
         :return: None
         """
 
+        if self.workers > 1:
+            self._run_workers(path, compress_level)
+            return
+
         for i, capture in enumerate(self.capture_list):
-            capture.save(path + '{:02d}'.format(i) + '.png')
+            capture.save(path + '{:02d}'.format(i) + '.png', compress_level=compress_level)
+
+    def _run_workers(self, path: str, compress_level: int) -> None:
+        """
+        Renders and saves the captures in a process pool. The conversation is split in contiguous ranges, one per
+        task. The preset, the name and the time are sent once to each process.
+        :param path: the captures are saved in this path by the workers
+        :param compress_level: PNG compression level (0-9)
+        :return: None
+        """
+
+        nb_captures = len(self.conversation)
+        nb_tasks = max(1, min(self.workers, nb_captures))
+        bounds = [nb_captures * k // nb_tasks for k in range(nb_tasks + 1)]
+
+        with ProcessPoolExecutor(max_workers=nb_tasks, initializer=_init_capture_worker,
+                                 initargs=(self.preset, self.name, self.time)) as executor:
+            futures = [executor.submit(_render_capture_range, self.conversation, bounds[k], bounds[k + 1], path,
+                                       compress_level) for k in range(nb_tasks)]
+            for future in futures:
+                future.result()
+        print(f'ScreenGenerator INFO: {nb_captures} captures rendered by {nb_tasks} workers')
+
+
+def _render_message_boxes(
+        conversation: List[Tuple[bool, str]],
+        preset: Dict,
+        rasterize: Optional[bool] = True
+) -> List[MessageBox]:
+    """
+    Renders every message of a conversation once
+    :param conversation: the conversation
+    :param preset: the options of the preset
+    :param rasterize: if false, the message boxes are only measured, `draw_background` and `draw_text` are left to
+    the caller. Defaults to True
+    :return: the list of rendered message boxes
+    """
+
+    messages = []
+    texts = format_text_box([message[1] for message in conversation], preset['message_max_width'],
+                            preset['message_font'])
+    for message, text in zip(conversation, texts):
+        message_box = MessageBox(text, message[0], preset, text_formatted=True)
+        if rasterize:
+            message_box.draw_background()
+            message_box.draw_text()
+        messages.append(message_box)
+    return messages
+
+
+def _first_visible_message(messages: List[MessageBox], preset: Dict) -> int:
+    """
+    Finds the first message visible in a message area showing the given messages, scrolled to the bottom. Only the
+    sizes of the boxes are used, they do not need to be rasterized.
+    :param messages: the messages of the area
+    :param preset: the options of the preset
+    :return: index of the first visible message
+    """
+
+    bottoms = []
+    y = preset['message_y_margin']
+    for message in messages:
+        y += message.box_size[1]
+        bottoms.append(y)
+        y += preset['message_y_margin']
+    return bisect.bisect_right(bottoms, max(0, y - preset['message_area_size'][1]))
+
+
+def _iter_incremental_captures(
+        conversation: List[Tuple[bool, str]],
+        messages: List[MessageBox],
+        start: int,
+        stop: int,
+        preset: Dict,
+        name: str,
+        time: str
+) -> Iterator[Capture]:
+    """
+    Yields the captures showing conversation[:start+1] to conversation[:stop], sharing the rendered messages. Each
+    message area is drawn from the previous one. Captures are not yet generated.
+    :param conversation: the conversation
+    :param messages: the rendered messages of the conversation, at least up to stop
+    :param start: index of the first capture
+    :param stop: index after the last capture
+    :param preset: the options of the preset
+    :param name: the name of the interlocutor
+    :param time: the time to display
+    :return: iterator of captures
+    """
+
+    message_area = None
+    for i in range(start, stop):
+        message_area = MessageArea(messages[:i+1], preset_options=preset, previous_area=message_area)
+        yield Capture(
+            preset['background_path'],
+            preset['avatar_path'],
+            conversation[:i+1],
+            name=name,
+            time=time,
+            preset_options=preset,
+            message_area=message_area,
+            messages=messages[:i+1]
+        )
+
+
+# options of the capture rendering process, set once by `_init_capture_worker`
+_worker_options: Dict = {}
+
+
+def _init_capture_worker(preset: Dict, name: str, time: str) -> None:
+    _worker_options['preset'] = preset
+    _worker_options['name'] = name
+    _worker_options['time'] = time
+
+
+def _render_capture_range(
+        conversation: List[Tuple[bool, str]],
+        start: int,
+        stop: int,
+        path: str,
+        compress_level: int
+) -> None:
+    """
+    Renders and saves the captures start to stop-1 in a worker process. The scroll only goes down, so the messages
+    above the first capture of the range are never visible and are not rasterized.
+    :return: None
+    """
+
+    preset = _worker_options['preset']
+    messages = _render_message_boxes(conversation[:stop], preset, rasterize=False)
+    for message in messages[_first_visible_message(messages[:start + 1], preset):]:
+        message.draw_background()
+        message.draw_text()
+    captures = _iter_incremental_captures(conversation, messages, start, stop, preset, _worker_options['name'],
+                                          _worker_options['time'])
+    for i, capture in zip(range(start, stop), captures):
+        capture.save(path + '{:02d}'.format(i) + '.png', compress_level=compress_level)
+
+
+def benchmark_bubble_backgrounds(
+        sizes: Optional[List[Tuple[int, int]]] = None,
+        repeat: Optional[int] = 20,
+        preset: Optional[Dict] = background_standard_options
+) -> Dict[str, float]:
+    """
+    Micro-benchmark of the message box backgrounds, `rounded_rectangle` against `BubbleSprite`
+    :param sizes: sizes of the boxes. Defaults to usual message sizes
+    :param repeat: number of times each size is drawn
+    :param preset: the options of the preset
+    :return: the mean time of a box in seconds for each method
+    """
+
+    if sizes is None:
+        sizes = [(w, h) for w in range(200, 700, 50) for h in (111, 157, 203, 249, 341)]
+    color = preset['message_background_color_sending']
+    radius = preset['message_radius']
+    sprite = BubbleSprite.get(color, radius)
+
+    start = perf_counter()
+    for _ in range(repeat):
+        for size in sizes:
+            ImageDraw.Draw(Image.new('RGBA', size)).rounded_rectangle([0, 0, *size], radius=radius, fill=color)
+    reference = (perf_counter() - start) / (repeat * len(sizes))
+
+    start = perf_counter()
+    for _ in range(repeat):
+        for size in sizes:
+            sprite.draw(Image.new('RGBA', size), size)
+    sprites = (perf_counter() - start) / (repeat * len(sizes))
+
+    print(f'BubbleSprite INFO: rounded_rectangle {reference * 1e6:.0f} us, sprite {sprites * 1e6:.0f} us '
+          f'({reference / sprites:.1f}x)')
+    return {'rounded_rectangle': reference, 'sprite': sprites}
+
+
+def benchmark_text_rendering(
+        texts: Optional[List[str]] = None,
+        preset: Optional[Dict] = background_standard_options
+) -> Dict[str, float]:
+    """
+    Micro-benchmark and image diff of the message texts, Pilmoji against `GlyphAtlas`
+    :param texts: texts of the messages. Defaults to sample messages
+    :param preset: the options of the preset
+    :return: the mean time of a message in seconds for each renderer, and the maximum difference of a pixel channel
+    """
+
+    if texts is None:
+        texts = ['Salut, tu viens ce soir ?', 'Non 🤨', "Et tu connais l'histoire du pingouin qui respire par les "
+                 'fesses ? 🐧', 'Ah voilà, tu commences à comprendre !'] * 5
+    times = {'pilmoji': 0.0, 'glyph_atlas': 0.0}
+    difference = 0
+    for i, text in enumerate(texts):
+        canvases = []
+        for renderer in times:
+            message = MessageBox(text, i % 2 == 0, dict(preset, glyph_atlas=renderer == 'glyph_atlas'))
+            message.draw_background()
+            start = perf_counter()
+            message.draw_text()
+            times[renderer] += perf_counter() - start
+            canvases.append(np.asarray(message.canvas, dtype=np.int16))
+        difference = max(difference, int(np.abs(canvases[0] - canvases[1]).max()))
+
+    print(f'GlyphAtlas INFO: Pilmoji {times["pilmoji"] / len(texts) * 1e3:.2f} ms, atlas '
+          f'{times["glyph_atlas"] / len(texts) * 1e3:.2f} ms, max difference {difference}')
+    result = {renderer: total / len(texts) for renderer, total in times.items()}
+    result['max_difference'] = difference
+    return result
@@ -1,7 +1,151 @@
+import json
+import math
+import os
 import random
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Dict, Any, List
-from PIL import ImageFont
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, Any, List, Tuple, Union, Optional, Iterable, Set
+import numpy as np
+from PIL import Image, ImageFont
+from pilmoji import getsize
+from pilmoji.helpers import EMOJI_REGEX, NodeType, to_nodes
+from pilmoji.source import BaseSource, AppleEmojiSource
+
+
+class LocalEmojiSource(BaseSource):
+    """
+    Emoji source for Pilmoji that keeps the emoji images in a memory cache shared by the whole process, backed by
+    a directory of PNG files. The emojis missing from both are downloaded from REMOTE_SOURCE, unless OFFLINE is set,
+    in which case they are rendered as text. Use `prefetch_emojis` to fill the cache before rendering.
+    The cache keeps the PNG data, not decoded images: Pilmoji only takes file-like objects from a source and decodes
+    and resizes them itself. The decoded and resized emojis are cached by `GlyphAtlas.get_emoji`, used when the
+    preset enables 'glyph_atlas'.
+    """
+
+    DIRECTORY: str = './data/emojis/'
+    REMOTE_SOURCE: type = AppleEmojiSource
+    OFFLINE: bool = False
+
+    _memory_cache: Dict[str, Optional[bytes]] = {}
+    _lock: threading.Lock = threading.Lock()
+
+    def get_emoji(self, emoji: str, /) -> Optional[BytesIO]:
+        data = self.get_emoji_bytes(emoji)
+        if data is None:
+            return None
+        return BytesIO(data)
+
+    def get_discord_emoji(self, id: int, /) -> Optional[BytesIO]:
+        return None
+
+    @classmethod
+    def get_emoji_bytes(cls, emoji: str, download: Optional[bool] = True) -> Optional[bytes]:
+        """
+        Returns the PNG data of an emoji, from memory, from the disk or from the remote source
+        :param emoji: the emoji
+        :param download: if false, the remote source is not used
+        :return: PNG data, or None if the emoji is not available
+        """
+
+        if emoji in cls._memory_cache:
+            return cls._memory_cache[emoji]
+
+        path = cls.get_emoji_path(emoji)
+        data = None
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+        elif download and not cls.OFFLINE:
+            data = cls._download(emoji)
+            if data is not None:
+                os.makedirs(cls.DIRECTORY, exist_ok=True)
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+        elif not download:
+            return None
+
+        with cls._lock:
+            cls._memory_cache[emoji] = data
+        return data
+
+    @classmethod
+    def get_emoji_path(cls, emoji: str) -> str:
+        """
+        Returns the path of the PNG file of an emoji
+        :param emoji: the emoji
+        :return: path
+        """
+
+        return os.path.join(cls.DIRECTORY, '-'.join(f'{ord(char):x}' for char in emoji) + '.png')
+
+    @classmethod
+    def _download(cls, emoji: str) -> Optional[bytes]:
+        try:
+            stream = cls.REMOTE_SOURCE().get_emoji(emoji)
+        except Exception as e:
+            print('LocalEmojiSource ERROR: could not download', emoji, e)
+            return None
+        if stream is None:
+            print('LocalEmojiSource ERROR: emoji not found', emoji)
+            return None
+        return stream.getvalue()
+
+
+def find_emojis(texts: Iterable[str]) -> Set[str]:
+    """
+    Returns all the emojis contained in the given texts
+    :param texts: the texts to scan
+    :return: set of emojis
+    """
+
+    emojis = set()
+    for text in texts:
+        for i, chunk in enumerate(EMOJI_REGEX.split(text)):
+            if i % 2 and len(chunk) <= 18:  # longer chunks are Discord emojis
+                emojis.add(chunk)
+    return emojis
+
+
+def prefetch_emojis(
+        conversations: Union[str, Iterable[Dict]],
+        name_list_path: Optional[str] = None,
+        max_workers: Optional[int] = 8
+) -> int:
+    """
+    Fills the cache of LocalEmojiSource with every emoji used in conversations, so that rendering does not wait on
+    the network
+    :param conversations: the conversations (dict with 'intro' and 'conversation' keys), or the path to a JSON file
+    containing a list of them
+    :param name_list_path: path to the list of names, whose emojis are also fetched. Optional
+    :param max_workers: number of parallel downloads. Defaults to 8
+    :return: number of emojis available in the cache
+    """
+
+    if isinstance(conversations, str):
+        with open(conversations, 'r', encoding='utf-8') as f:
+            conversations = json.load(f)
+
+    texts = []
+    for conv_data in conversations:
+        if conv_data.get('intro'):
+            texts.append(conv_data['intro'])
+        texts.extend(replica[1] for replica in conv_data['conversation'])
+    if name_list_path:
+        with open(name_list_path, 'r', encoding='utf-8') as f:
+            texts.extend(f.readlines())
+
+    emojis = find_emojis(texts)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(LocalEmojiSource.get_emoji_bytes, emojis))
+    available = sum(1 for data in results if data is not None)
+    print(f'LocalEmojiSource INFO: {available}/{len(emojis)} emojis prefetched')
+    return available
+
 
 background_standard_options: Dict[str, Any] = {
     'name_y_position': 290,
@@ -24,13 +168,338 @@ background_standard_options: Dict[str, Any] = {
     'background_path': Path('Ressources/base sms iphone.png'),
     'avatar_path': Path('Ressources/profile default.png'),
     'intro_background_directory': 'Ressources/intro backgrounds/',
+    'intro_cache_directory': './data/intro_cache/',
     'intro_font': ImageFont.truetype(font='utils/fonts/OpenSans-Bold.ttf', size=90),
     'intro_text_background_padding': 10,
     'intro_text_background_radius': 20,
-    'name_list_path': 'Ressources/names.txt'
+    'name_list_path': 'Ressources/names.txt',
+    'emoji_source': LocalEmojiSource,
+    'glyph_atlas': False
 }
 
 
+class PersistentLRUCache:
+    """
+    LRU cache of values keyed by tuples of JSON values. It can be saved to a JSON file so that a new process starts
+    with the entries of the previous ones.
+
+    :param max_size: maximum number of entries kept in memory. Defaults to 100000
+    :param path: path of the JSON file used by `load` and `save`. If it exists, it is loaded. Optional
+    """
+
+    def __init__(
+            self,
+            max_size: Optional[int] = 100000,
+            path: Optional[str] = None
+    ) -> None:
+        self.max_size: int = max_size
+        self.path: Optional[str] = path
+        self.hits: int = 0
+        self.misses: int = 0
+
+        self._entries: OrderedDict = OrderedDict()
+        self._new_entries: OrderedDict = OrderedDict()  # entries set since the last `pop_new_entries`
+        self._lock: threading.Lock = threading.Lock()
+
+        if self.path and os.path.isfile(self.path):
+            self.load()
+
+    def pop_new_entries(self) -> List[List]:
+        """
+        Returns the entries set since the last call, for example to send the entries computed in a worker process to
+        the process saving the cache (see `update`)
+        :return: list of [*key, value]
+        """
+
+        with self._lock:
+            entries = [[*key, value] for key, value in self._new_entries.items()]
+            self._new_entries.clear()
+        return entries
+
+    def update(self, entries: List[List], hits: Optional[int] = 0, misses: Optional[int] = 0) -> None:
+        """
+        Adds entries given by `pop_new_entries`
+        :param entries: list of [*key, value]
+        :param hits: number of hits to add to the counter, for example the hits of a worker process. Defaults to 0
+        :param misses: number of misses to add to the counter. Defaults to 0
+        :return: None
+        """
+
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            for entry in entries:
+                self._entries[tuple(entry[:-1])] = entry[-1]
+            self._evict()
+
+    def hit_rate(self) -> float:
+        """
+        Returns the proportion of values found in the cache
+        :return: hit rate (0-1)
+        """
+
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def load(self, path: Optional[str] = None) -> None:
+        """
+        Loads the entries saved in a JSON file. The loaded entries are added to the ones already in memory
+        :param path: path to the file. Defaults to the path given to the constructor
+        :return: None
+        """
+
+        path = path or self.path
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f)
+        with self._lock:
+            for entry in entries:
+                self._entries[tuple(entry[:-1])] = self._decode(entry[-1])
+            self._evict()
+        print(f'{type(self).__name__} INFO: {len(entries)} entries loaded from {path}')
+
+    def save(self, path: Optional[str] = None) -> None:
+        """
+        Saves the entries in a JSON file. The file is replaced atomically
+        :param path: path to the file. Defaults to the path given to the constructor
+        :return: None
+        """
+
+        path = path or self.path
+        with self._lock:
+            entries = [[*key, value] for key, value in self._entries.items()]
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        print(f'{type(self).__name__} INFO: {len(entries)} entries saved, hit rate: {self.hit_rate():.1%} '
+              f'({self.hits} hits, {self.misses} misses)')
+
+    def _decode(self, value: Any) -> Any:
+        """
+        Converts a value read from JSON to the type of the cached values
+        """
+
+        return value
+
+    def _get(self, key: Tuple) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: Tuple, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._new_entries[key] = value
+            self._evict()
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        while len(self._new_entries) > self.max_size:
+            self._new_entries.popitem(last=False)
+
+
+class MetricsCache(PersistentLRUCache):
+    """
+    `PersistentLRUCache` of text measures (`font.getlength` and pilmoji `getsize`), keyed by (font file, font size,
+    text).
+    """
+
+    def get_length(self, text: str, font: ImageFont.FreeTypeFont) -> float:
+        """
+        Returns the length in pixels of a single line text, like `font.getlength`
+        :param text: the text to measure
+        :param font: the font used
+        :return: length in pixels, float
+        """
+
+        key = (getattr(font, 'path', str(id(font))), getattr(font, 'size', 0), 'length', text)
+        value = self._get(key)
+        if value is None:
+            value = font.getlength(text)
+            self._set(key, value)
+        return value
+
+    def get_size(self, text: str, font: ImageFont.FreeTypeFont) -> Tuple[int, int]:
+        """
+        Returns the size in pixels of a text that can contain emojis and returns to line, like pilmoji `getsize`
+        :param text: the text to measure
+        :param font: the font used
+        :return: width and height in pixels
+        """
+
+        key = (getattr(font, 'path', str(id(font))), getattr(font, 'size', 0), 'size', text)
+        value = self._get(key)
+        if value is None:
+            value = tuple(getsize(text, font=font))
+            self._set(key, value)
+        return value
+
+    def _decode(self, value: Any) -> Any:
+        return tuple(value) if isinstance(value, list) else value
+
+
+# measures shared by all the fonts of the presets
+metrics_cache: MetricsCache = MetricsCache()
+
+
+class GlyphAtlas:
+    """
+    Already rasterized glyphs and emojis of a font, to draw texts like `Pilmoji.text` (anchor 'la', align left) without
+    FreeType. A line is composed from the glyph masks at the same positions as FreeType, then filled with the colour,
+    so the glyph masks are shared by all the colours. Use `GlyphAtlas.get` to share the atlases.
+
+    :param font: the font of the atlas
+    """
+
+    _atlases: Dict[Tuple[str, int], 'GlyphAtlas'] = {}
+    _lock: threading.Lock = threading.Lock()
+
+    def __init__(self, font: ImageFont.FreeTypeFont) -> None:
+        self.font: ImageFont.FreeTypeFont = font
+        self.space_length: float = font.getlength(' ')
+        self.line_spacing: int = font.getbbox('A')[3] + 4  # like Pilmoji, with the default spacing of 4
+
+        self._glyphs: Dict[str, Tuple[np.ndarray, Tuple[int, int], float]] = {}
+        self._emojis: Dict[Tuple[Any, str, int], Optional[Image.Image]] = {}
+        self._sources: Dict[Any, BaseSource] = {}
+
+    @classmethod
+    def get(cls, font: ImageFont.FreeTypeFont) -> 'GlyphAtlas':
+        """
+        Gives the atlas of a font, created the first time
+        :param font: the font
+        :return: the atlas
+        """
+
+        key = (getattr(font, 'path', str(id(font))), getattr(font, 'size', 0))
+        with cls._lock:
+            atlas = cls._atlases.get(key)
+            if atlas is None:
+                atlas = cls._atlases[key] = cls(font)
+        return atlas
+
+    def get_glyph(self, char: str) -> Tuple[np.ndarray, Tuple[int, int], float]:
+        """
+        Gives the glyph of a character, rasterized the first time
+        :param char: the character
+        :return: the mask (height, width) uint8, its offset from the origin of the character and the advance
+        """
+
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            mask, offset = self.font.getmask2(char, 'L', anchor='la')
+            array = np.asarray(mask, dtype=np.uint8).reshape(mask.size[1], mask.size[0])
+            glyph = self._glyphs[char] = (array, offset, self.font.getlength(char))
+        return glyph
+
+    def get_emoji(self, emoji: str, width: int, source: Any) -> Optional[Image.Image]:
+        """
+        Gives an emoji resized like Pilmoji does, loaded the first time
+        :param emoji: the emoji
+        :param width: width of the emoji in pixels
+        :param source: the emoji source class, see `background_standard_options['emoji_source']`
+        :return: the RGBA image, None if the source does not have it
+        """
+
+        key = (source, emoji, width)
+        if key not in self._emojis:
+            if source not in self._sources:
+                self._sources[source] = source() if isinstance(source, type) else source
+            stream = self._sources[source].get_emoji(emoji)
+            image = None
+            if stream:
+                with Image.open(stream).convert('RGBA') as asset:
+                    size = width, round(math.ceil(asset.height / asset.width * width))
+                    image = asset.resize(size, Image.Resampling.LANCZOS)
+            self._emojis[key] = image
+        return self._emojis[key]
+
+    def get_line_mask(self, text: str) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Composes the mask of a single line text, like `font.getmask2(text, 'L', anchor='la')`
+        :param text: the line
+        :return: the mask (height, width) uint8 and its offset from the origin of the text
+        """
+
+        if not text:
+            return np.zeros((0, 0), dtype=np.uint8), (0, 0)
+
+        glyphs = []
+        pen = 0.0
+        for char in text:
+            glyph = self.get_glyph(char)
+            glyphs.append((pen, glyph))
+            pen += glyph[2]
+
+        x0 = int(min(0, min(p + g[1][0] for p, g in glyphs)))
+        y0 = min(g[1][1] for _, g in glyphs)
+        x1 = int(max(pen, max(p + g[1][0] + g[0].shape[1] for p, g in glyphs)))
+        y1 = max(g[1][1] + g[0].shape[0] for _, g in glyphs)
+
+        line = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        for p, (mask, offset, _) in glyphs:
+            x = int(p) + offset[0] - x0
+            y = offset[1] - y0
+            target = line[y:y + mask.shape[0], x:x + mask.shape[1]]
+            np.maximum(target, mask, out=target)  # FreeType keeps the maximum where glyphs overlap
+        return line, (x0, y0)
+
+    def draw_text(
+            self,
+            canvas: Image.Image,
+            xy: Tuple[int, int],
+            text: str,
+            fill: Tuple[int, ...],
+            source: Any,
+            emoji_position_offset: Optional[Tuple[int, int]] = (0, 0),
+            emoji_scale_factor: Optional[float] = 1
+    ) -> None:
+        """
+        Draws a text that can contain emojis and returns to line, like `Pilmoji.text`
+        :param canvas: the canvas
+        :param xy: position of the upper left of the text
+        :param text: the text
+        :param fill: the colour of the text
+        :param source: the emoji source class
+        :param emoji_position_offset: offset of the emojis, like Pilmoji
+        :param emoji_scale_factor: scale of the emojis, like Pilmoji
+        :return: None
+        """
+
+        y = xy[1]
+        ox, oy = emoji_position_offset
+        emoji_width = round(emoji_scale_factor * self.font.size)
+        for line in to_nodes(text):
+            nodes = []
+            text_line = ''
+            for node in line:
+                image = self.get_emoji(node.content, emoji_width, source) if node.type is NodeType.emoji else None
+                nodes.append((node.content, image))
+                if image is None:
+                    text_line += node.content
+                else:
+                    text_line += ' ' * round(round(emoji_width + ox) / self.space_length)
+
+            mask, offset = self.get_line_mask(text_line)
+            x, line_y = int(xy[0]) + offset[0], int(y) + offset[1]
+            if mask.size:
+                canvas.paste(fill, (x, line_y, x + mask.shape[1], line_y + mask.shape[0]), Image.fromarray(mask))
+
+            for content, image in nodes:
+                if image is None:
+                    x += int(sum(self.get_glyph(char)[2] for char in content))
+                else:
+                    canvas.paste(image, (round(x + ox), round(line_y + oy)), image)
+                    x += emoji_width
+            y += self.line_spacing
+
+
 def choose_random_name(path: str) -> str:
     """
     Returns a name chosen randomly from a text file
@@ -42,58 +511,262 @@ def choose_random_name(path: str) -> str:
         return random.choice(names)
 
 
-def get_crop_region(size):
-    x0 = (size[0]//2) - 540
-    x1 = (size[0]//2) + 540
-    y0 = (size[1]//2) - 960
-    y1 = (size[1]//2) + 960
+def get_crop_region(size, target_size=(1080, 1920)):
+    x0 = (size[0]//2) - target_size[0]//2
+    x1 = (size[0]//2) + target_size[0] - target_size[0]//2
+    y0 = (size[1]//2) - target_size[1]//2
+    y1 = (size[1]//2) + target_size[1] - target_size[1]//2
     return x0, y0, x1, y1
 
 
-def format_text_box(text: str, max_width: int, font: ImageFont.ImageFont) -> str:
+def load_background(path: Union[str, Path], size: Tuple[int, int] = (1080, 1920)) -> Image.Image:
+    """
+    Loads an image scaled and cropped to fill the given size. JPEG images are decoded at a reduced scale when they are
+    at least twice as big as needed.
+    :param path: path of the image
+    :param size: size of the result
+    :return: the image
+    """
+
+    with Image.open(path) as im:
+        original_size = im.size
+        if original_size[0] / original_size[1] < size[0] / size[1]:  # image trop fine
+            scale = size[0] / original_size[0]
+        else:  # trop large
+            scale = size[1] / original_size[1]
+        scaled_size = (int(scale * original_size[0]), int(scale * original_size[1]))
+
+        if im.format == 'JPEG':
+            im.draft('RGB', scaled_size)
+        resized = im.resize(scaled_size, reducing_gap=3.0)
+
+    return resized.crop(get_crop_region(resized.size, size))
+
+
+class IntroBackgroundCache:
+    """
+    Cache of the intro backgrounds of a directory, already scaled and cropped to the size of the intro. The names of
+    the images are indexed in memory, the directory is listed again only when its mtime changes. Each background is
+    stored uncompressed in cache_directory (BMP, much faster to decode than a PNG or a JPEG) and invalidated when the
+    mtime of its image changes. The last backgrounds used are also kept in memory. Use `IntroBackgroundCache.get` to
+    share the caches.
+
+    :param directory: directory of the intro backgrounds
+    :param size: size of the backgrounds. Defaults to 1080*1920
+    :param cache_directory: directory of the scaled backgrounds. If None, they are only kept in memory
+    :param max_images: maximum number of backgrounds kept in memory. Defaults to 4
+    :param mode: mode of the backgrounds. Defaults to RGB, like the intro canvas
+    """
+
+    _caches: Dict[Tuple[str, Tuple[int, int], Optional[str]], 'IntroBackgroundCache'] = {}
+    _caches_lock: threading.Lock = threading.Lock()
+
+    def __init__(
+            self,
+            directory: str,
+            size: Optional[Tuple[int, int]] = (1080, 1920),
+            cache_directory: Optional[str] = None,
+            max_images: Optional[int] = 4,
+            mode: Optional[str] = 'RGB'
+    ) -> None:
+        self.directory: str = directory
+        self.size: Tuple[int, int] = tuple(size)
+        self.cache_directory: Optional[str] = cache_directory
+        self.max_images: int = max_images
+        self.mode: str = mode
+
+        self._index: Dict[str, int] = {}  # mtime of each image
+        self._names: List[str] = []
+        self._directory_mtime: Optional[int] = None
+        self._images: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    @classmethod
+    def get(
+            cls,
+            directory: str,
+            size: Optional[Tuple[int, int]] = (1080, 1920),
+            cache_directory: Optional[str] = None
+    ) -> 'IntroBackgroundCache':
+        """
+        Gives the cache of a directory, created the first time
+        :param directory: directory of the intro backgrounds
+        :param size: size of the backgrounds
+        :param cache_directory: directory of the scaled backgrounds
+        :return: the cache
+        """
+
+        key = (directory, tuple(size), cache_directory)
+        with cls._caches_lock:
+            cache = cls._caches.get(key)
+            if cache is None:
+                cache = cls._caches[key] = cls(directory, size, cache_directory)
+        return cache
+
+    def refresh(self) -> None:
+        """
+        Lists the directory again if it changed since the last time
+        :return: None
+        """
+
+        mtime = os.stat(self.directory).st_mtime_ns
+        with self._lock:
+            if mtime == self._directory_mtime:
+                return
+            index = {}
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        index[entry.name] = entry.stat().st_mtime_ns
+            self._index = index
+            self._names = sorted(index)
+            self._directory_mtime = mtime
+
+    def choose(self) -> str:
+        """
+        Chooses a random image in the directory
+        :return: name of the image
+        """
+
+        self.refresh()
+        return random.choice(self._names)
+
+    def get_background(self, name: str) -> Image.Image:
+        """
+        Gives the scaled background of an image, from memory, from the cache directory or from the image
+        :param name: name of the image in the directory
+        :return: the background, do not modify it
+        """
+
+        path = os.path.join(self.directory, name)
+        mtime = os.stat(path).st_mtime_ns  # an image rewritten in place does not change the mtime of the directory
+        key = (name, mtime)
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                return image
+
+        cache_path = None
+        if self.cache_directory:
+            cache_path = os.path.join(self.cache_directory,
+                                      f'{name}.{self.size[0]}x{self.size[1]}.{self.mode}.{mtime}.bmp')
+        image = None
+        if cache_path and os.path.isfile(cache_path):
+            try:
+                with Image.open(cache_path) as im:
+                    image = im.copy()
+            except FileNotFoundError:  # removed by another process since, the image changed again
+                pass
+        if image is None:
+            image = load_background(path, self.size).convert(self.mode)
+            if cache_path:
+                self._store(name, image, cache_path)
+
+        with self._lock:
+            self._images[key] = image
+            while len(self._images) > self.max_images:
+                self._images.popitem(last=False)
+        return image
+
+    def _store(self, name: str, image: Image.Image, cache_path: str) -> None:
+        """
+        Writes a background in the cache directory and removes the outdated versions of the same image
+        :return: None
+        """
+
+        os.makedirs(self.cache_directory, exist_ok=True)
+        prefix = f'{name}.{self.size[0]}x{self.size[1]}.{self.mode}.'
+        current = os.path.basename(cache_path)
+        for file in os.listdir(self.cache_directory):
+            # versions of other mtimes of the image, the current one can be read by another process
+            if file.startswith(prefix) and file.endswith('.bmp') and file != current:
+                try:
+                    os.remove(os.path.join(self.cache_directory, file))
+                except OSError:
+                    pass
+        tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        image.save(tmp_path, format='BMP')
+        os.replace(tmp_path, cache_path)
+
+
+def format_text_box(text: Union[str, List[str]], max_width: int,
+                    font: ImageFont.ImageFont) -> Union[str, List[str]]:
     """
-    Format a given text to fit within the max width by adding returns to line where needed
+    Format a given text to fit within the max width by adding returns to line where needed.
+    Each word is measured once per font (see `get_word_width`) and the line widths are accumulated word by word.
+    A word that does not fit on a line by itself is split over several lines.
 
     :param font: the font to use
     :type font: class: `ImageFont.ImageFont`
-    :param text: the text to format
-    :type text: str
+    :param text: the text to format, or a list of texts to format in one call
+    :type text: Union[str, List[str]]
     :param max_width: the maximum width of the resulting text (the result can be thinner)
     :type max_width: int
-    :return: str: The formatted text compatible with the `maw_width` parameter
-    """
-
-    text_list = text.split()
-    nb_words = len(text_list)
-    last_words = [0]  # List containing the positions of last words of different lines
-
-    nw = 0
-    nl = 0
-    while nw < nb_words:
-        length = get_text_size(text_list[last_words[nl]:nw+1], font)
-        # print(length, text_list[last_words[nl]:nw+1])
-        if length > max_width:
-            last_words.append(nw)
-            # print(last_words)
-            nl += 1
-        nw += 1
-
-    # print(last_words)
-
-    # print(text_list)
-    for i in range(len(last_words)):
-        if i == 0:
-            pass
+    :return: str: The formatted text compatible with the `maw_width` parameter, or the list of formatted texts
+    """
+
+    if not isinstance(text, str):
+        return [format_text_box(t, max_width, font) for t in text]
+
+    lines = []
+    line = []
+    line_width = 0
+    for word in text.split():
+        word_width = get_word_width(word, font)
+        if word_width > max_width:  # the word alone is too long, it is cut
+            chunks = _split_long_word(word, max_width, font)
+            if line:
+                lines.append(' '.join(line))
+            lines.extend(chunks[:-1])
+            word = chunks[-1]
+            word_width = get_word_width(word, font)
+            line = []
+        elif line and line_width + 1 + word_width > max_width:  # 1px between each word, like `get_text_size`
+            lines.append(' '.join(line))
+            line = []
+
+        if line:
+            line_width += 1 + word_width
+        else:
+            line_width = word_width
+        line.append(word)
+
+    if line:
+        lines.append(' '.join(line))
+    return '\n'.join(lines)
+
+
+def _split_long_word(word: str, max_width: int, font: ImageFont.ImageFont) -> List[str]:
+    """
+    Cuts a word that is wider than max_width into pieces that fit
+    :param word: the word to cut
+    :param max_width: the maximum width of each piece
+    :param font: the font to use
+    :return: the list of pieces
+    """
+
+    chunks = []
+    chunk = ''
+    for char in word:
+        if chunk and get_word_width(chunk + char, font) > max_width:
+            chunks.append(chunk)
+            chunk = char
         else:
-            text_list[last_words[i]-1] = text_list[last_words[i]-1] + '\n'
+            chunk += char
+    chunks.append(chunk)
+    return chunks
+
+
+def get_word_width(word: str, font: ImageFont.ImageFont) -> int:
+    """
+    Returns the length in pixels of a word. Words are measured only once per font (see `metrics_cache`).
+    :param word: the word to measure
+    :param font: the font used to calculate the length
+    :return: length in pixels, int
+    """
 
-    # print(text_list)
-    res = ''
-    for i, word in enumerate(text_list):
-        res += word
-        if i < len(text_list) - 1 and i+1 not in last_words:
-            res += ' '
-    return res
+    return int(metrics_cache.get_length(word, font))
 
 
 def get_text_size(text_list: List[str], font: ImageFont.ImageFont) -> int:
@@ -109,7 +782,7 @@ def get_text_size(text_list: List[str], font: ImageFont.ImageFont) -> int:
 
     x = 0
     for word in text_list:
-        x += int(font.getlength(word))
+        x += get_word_width(word, font)
     x += len(text_list) - 1
 
     return x